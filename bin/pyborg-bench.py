@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+#
+# PyBorg benchmarks
+#
+# Measures how fast a brain learns, replies, loads and saves at
+# different sizes, so changes to PyborgBrain can be compared.
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+
+import argparse
+import bisect
+from itertools import chain, islice
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import metrics
+import pyborg
+
+
+log = logging.getLogger('pyborg-bench')
+
+# Metrics where a bigger number is better. For the others, smaller is.
+higher_is_better = frozenset(['learn_lines_per_sec'])
+
+
+def synthetic_corpus(seed, vocabulary_size=50000):
+    """
+    Generate an endless, repeatable stream of lines of pronounceable
+    words, drawn with a Zipf distribution like real chat.
+    """
+    rng = random.Random(seed)
+    consonants, vowels = 'bcdfghjklmnprstvwz', 'aeiou'
+    vocabulary = list()
+    known = set()
+    while len(vocabulary) < vocabulary_size:
+        word = ''.join(rng.choice(consonants) + rng.choice(vowels) for i in xrange(rng.randint(1, 4)))
+        if word not in known:
+            known.add(word)
+            vocabulary.append(word)
+
+    cumulative_weights = list()
+    total = 0.0
+    for rank in xrange(1, vocabulary_size + 1):
+        total += 1.0 / rank
+        cumulative_weights.append(total)
+
+    while True:
+        num_words = rng.randint(3, 15)
+        yield ' '.join(vocabulary[bisect.bisect(cumulative_weights, rng.random() * total)]
+            for i in xrange(num_words))
+
+
+def file_corpus(filename):
+    """
+    Replay the lines of a file, starting over when it runs out.
+    """
+    while True:
+        with open(filename, 'r') as f:
+            for line in f:
+                yield line
+
+
+def percentile(sorted_values, fraction):
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def run_size(num_lines, corpus_file, seed, num_replies):
+    """
+    Benchmark a brain of 'num_lines' lines, built from scratch in a
+    temporary directory. Run in a fresh process, so memory use from
+    one size doesn't spill into the next. Memory is measured as the
+    growth of RSS over base_rss, taken before learning.
+    """
+    workdir = tempfile.mkdtemp(prefix='pyborg-bench-')
+    os.chdir(workdir)
+    try:
+        with open('pyborg.cfg', 'w') as cfg:
+            cfg.write('max_words = %d\n' % sys.maxint)
+        rng = random.Random(seed)
+        corpus = file_corpus(corpus_file) if corpus_file else synthetic_corpus(seed)
+        # Start the corpus off, so its vocabulary is counted in base_rss.
+        corpus = chain([next(corpus)], corpus)
+
+        result = dict()
+        borg = pyborg.Pyborg(seed)
+        brain = borg.brain
+        # Decay is off, but the epoch is saved with the dictionary, and
+        # would otherwise make archive_size differ from run to run.
+        brain.decay_epoch = 0.0
+        base_rss = result['base_rss'] = metrics.rss()
+
+        # The corpus is generated as it's learned, outside the timing, so
+        # only a sample of it is held for prompts rather than all of it.
+        prompts = list()
+        elapsed = 0
+        for i, line in enumerate(islice(corpus, num_lines)):
+            t = time.time()
+            brain.learn(brain.filter_message(line))
+            elapsed += time.time() - t
+            if i < num_replies:
+                prompts.append(line)
+            else:
+                j = rng.randint(0, i)
+                if j < num_replies:
+                    prompts[j] = line
+        result['learn_lines_per_sec'] = num_lines / elapsed if elapsed else 0
+        result['learn_rss_growth'] = metrics.rss() - base_rss
+        result['words'] = brain.num_words
+        result['lines'] = brain.num_lines
+
+        latencies = list()
+        for prompt in prompts:
+            prompt = brain.filter_message(prompt)
+            t = time.time()
+            brain.reply(prompt)
+            latencies.append(time.time() - t)
+            brain.after_reply()
+        latencies.sort()
+        result['reply_p50'] = percentile(latencies, 0.50)
+        result['reply_p95'] = percentile(latencies, 0.95)
+        result['reply_p99'] = percentile(latencies, 0.99)
+        result['reply_rss_growth'] = metrics.rss() - base_rss
+
+        del prompts
+        t = time.time()
+        brain.save()
+        result['save_time'] = time.time() - t
+        result['save_rss_growth'] = metrics.rss() - base_rss
+        result['archive_size'] = os.path.getsize('archive.zip')
+
+        del borg.brain, brain
+        t = time.time()
+        brain = pyborg.PyborgBrain(borg.settings, borg.random)
+        result['load_time'] = time.time() - t
+        result['load_rss_growth'] = metrics.rss() - base_rss
+        return result
+    finally:
+        os.chdir('/')
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def parse_size(size):
+    multipliers = {'k': 10 ** 3, 'm': 10 ** 6}
+    size = size.strip().lower()
+    if size[-1:] in multipliers:
+        return int(float(size[:-1]) * multipliers[size[-1]])
+    return int(size)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print how 'results' differ from 'baseline', returning the number
+    of metrics that got worse by more than 'tolerance' (a fraction).
+    """
+    for key in ('corpus', 'seed', 'python'):
+        if results.get(key) != baseline.get(key):
+            print "Warning: %s was %s for the baseline but is %s now" % (key, baseline.get(key), results.get(key))
+
+    regressions = 0
+    for size, metrics in sorted(results['results'].iteritems(), key=lambda r: int(r[0])):
+        base_metrics = baseline['results'].get(size)
+        if base_metrics is None:
+            print "%s lines: not in the baseline" % size
+            continue
+        for metric, value in sorted(metrics.iteritems()):
+            base_value = base_metrics.get(metric)
+            if not base_value or metric in ('words', 'lines', 'base_rss'):
+                continue
+            change = (value - base_value) / float(base_value)
+            worse = -change if metric in higher_is_better else change
+            flag = ''
+            if worse > tolerance:
+                flag = '  REGRESSION'
+                regressions += 1
+            print "%s lines: %-20s %12.6g -> %12.6g (%+.1f%%)%s" % (
+                size, metric, base_value, value, change * 100, flag)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark PyBorg brains of several sizes.")
+    parser.add_argument('--sizes', default='10k,100k',
+        help="comma separated brain sizes in lines, eg. 10k,100k,1m,5m (default %(default)s)")
+    parser.add_argument('--corpus', metavar='FILE',
+        help="replay the lines of FILE instead of generating a synthetic corpus")
+    parser.add_argument('--seed', type=int, default=0, help="seed for the corpus and replies (default %(default)s)")
+    parser.add_argument('--replies', type=int, default=1000,
+        help="number of replies to time at each size (default %(default)s)")
+    parser.add_argument('-o', '--output', metavar='FILE', help="write the results as JSON to FILE")
+    parser.add_argument('--compare', metavar='BASELINE',
+        help="compare the results with a JSON file written by an earlier run")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+        help="fraction a metric may get worse before it's a regression (default %(default)s)")
+    options = parser.parse_args()
+
+    # Each size is run from its own temporary directory.
+    if options.corpus:
+        options.corpus = os.path.abspath(options.corpus)
+
+    logging.basicConfig(level=logging.WARNING)
+    log.setLevel(logging.INFO)
+
+    results = {
+        'python': platform.python_version(),
+        'corpus': options.corpus or 'synthetic',
+        'seed': options.seed,
+        'results': {},
+    }
+    for size in options.sizes.split(','):
+        num_lines = parse_size(size)
+        log.info("Benchmarking %d lines...", num_lines)
+        pool = multiprocessing.Pool(1)
+        try:
+            result = pool.apply(run_size, (num_lines, options.corpus, options.seed, options.replies))
+        finally:
+            pool.terminate()
+        log.info("%d lines: %s", num_lines, json.dumps(result, sort_keys=True))
+        results['results'][str(num_lines)] = result
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(results, baseline, options.tolerance):
+            sys.exit(1)
@@ -20,13 +20,83 @@
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 #
 
+import argparse
+import bz2
+import gzip
 import logging
-import string
+import marshal
+import multiprocessing
+import os
+import signal
 import sys
+import time
 
+import irclogs
 import pyborg
 
 
+def open_input(filename):
+    """
+    Open a text file for reading, decompressing .gz and .bz2 files
+    on the fly.
+    """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    if filename.endswith('.bz2'):
+        return bz2.BZ2File(filename, 'r')
+    return open(filename, 'r')
+
+
+def read_messages(f, log_format=None):
+    """
+    Iterate over the messages in the open file 'f': its lines, or what
+    was said in it if it's an IRC log in one of irclogs.formats.
+    """
+    if log_format is None:
+        return f
+    return irclogs.parse_log(f, log_format)
+
+
+# The brain the ingest pool workers filter with, set only while forking them.
+_ingest_brain = None
+
+
+def ignore_interrupts():
+    """
+    Pool initializer: leave Ctrl-C to the parent, which terminates the
+    pool itself. A worker killed by it would leave imap_unordered()
+    waiting forever for its result.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def learn_partial(task):
+    """
+    Filter the whole file of a (filename, log format) task into a
+    partial brain: a dict of clean sentence to [clean sentence, count],
+    whose values are ready for PyborgBrain.merge_lines(). Word
+    contexts aren't built here, merging recreates them from the line
+    text more cheaply than they could be sent back from the worker.
+    """
+    filename, log_format = task
+    brain = _ingest_brain
+    lines = {}
+    num_lines = 0
+    with open_input(filename) as f:
+        for line in read_messages(f, log_format):
+            num_lines += 1
+            for sentence in brain.filter_message(line).split('. '):
+                words = brain.clean_words(sentence)
+                if words is None:
+                    continue
+                line_text = " ".join(words)
+                try:
+                    lines[line_text][1] += 1
+                except KeyError:
+                    lines[line_text] = [line_text, 1]
+    return filename, num_lines, lines
+
+
 class ModFileIn:
     """
     Module for file input. Learning from ASCII text files.
@@ -36,26 +106,154 @@ class ModFileIn:
     commandlist = "FileIn Module Commands:\nNone"
     commanddict = {}
 
-    def __init__(self, borg, args):
-        for filename in args:
-            self.learn_file(borg, filename)
+    # Where import progress is recorded so an interrupted import can resume.
+    checkpoint_file = 'filein.checkpoint'
+
+    log = logging.getLogger('ModFileIn')
+
+    def __init__(self, borg, args, report_interval=10, checkpoint_lines=0, resume=False, jobs=1, log_format=None):
+        self.report_interval = report_interval
+        self.checkpoint_lines = checkpoint_lines
+        self.log_format = log_format
+
+        # Maps filenames to the number of lines learned from them, or
+        # None once the whole file has been learned.
+        self.progress = self.load_checkpoint() if resume else {}
+
+        if jobs > 1:
+            finished = self.learn_parallel(borg, args, jobs)
+        else:
+            finished = all(self.learn_file(borg, filename) for filename in args)
+        if finished:
+            self.clear_checkpoint()
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_file, 'rb') as checkpoint:
+                return marshal.load(checkpoint)
+        except (EOFError, IOError, ValueError):
+            return {}
+
+    def save_checkpoint(self):
+        with open(self.checkpoint_file + '.tmp', 'wb') as checkpoint:
+            marshal.dump(self.progress, checkpoint)
+        os.rename(self.checkpoint_file + '.tmp', self.checkpoint_file)
+
+    def clear_checkpoint(self):
+        try:
+            os.remove(self.checkpoint_file)
+        except OSError:
+            pass
 
     def learn_file(self, borg, filename):
-        with open(filename, 'r') as f:
-            buffer = f.read()
+        """
+        Learn a file line by line. Returns False if the import was
+        interrupted, after saving a checkpoint to resume from.
+        """
+        skip_lines = self.progress.get(filename, 0)
+        if skip_lines is None:
+            self.log.info("Already learned %s, skipping it", filename)
+            return True
+
+        self.log.info("I knew %d words (%d lines) before reading %s",
+            borg.brain.num_words, borg.brain.num_lines, filename)
+        if skip_lines:
+            self.log.info("Resuming %s after line %d", filename, skip_lines)
+
+        num_lines = 0
+        start_time = last_report = time.time()
+        try:
+            with open_input(filename) as f:
+                for line in read_messages(f, self.log_format):
+                    num_lines += 1
+                    if num_lines <= skip_lines:
+                        continue
 
-        logging.info("I knew %d words (%d lines) before reading %s",
-            borg.settings.num_words, len(borg.brain.lines), filename)
+                    borg.learn(borg.brain.filter_message(line))
 
-        buffer = borg.filter_message(buffer)
+                    if self.checkpoint_lines and not num_lines % self.checkpoint_lines:
+                        borg.save_all()
+                        self.progress[filename] = num_lines
+                        self.save_checkpoint()
+
+                    now = time.time()
+                    if now - last_report >= self.report_interval:
+                        self.log.info("%s: learned %d lines (%.0f lines/s), I know %d words",
+                            filename, num_lines, (num_lines - skip_lines) / (now - start_time), borg.brain.num_words)
+                        last_report = now
+        except KeyboardInterrupt:
+            # Whoever started us saves the brain on the way out, so resume from here.
+            self.progress[filename] = num_lines
+            self.save_checkpoint()
+            print "Premature termination :-( Run again with --resume to carry on."
+            return False
+
+        self.progress[filename] = None
+        if self.checkpoint_lines:
+            self.save_checkpoint()
+
+        elapsed = time.time() - start_time
+        self.log.info("I know %d words (%d lines) now! Read %d lines of %s in %.1fs (%.0f lines/s).",
+            borg.brain.num_words, borg.brain.num_lines, num_lines, filename, elapsed,
+            (num_lines - skip_lines) / elapsed if elapsed else 0)
+        return True
+
+    def learn_parallel(self, borg, filenames, jobs):
+        """
+        Filter the files into partial brains on a pool of 'jobs'
+        processes, one file per task, merging each into the brain as it
+        arrives. Files a previous serial import was interrupted in are
+        finished serially from where it stopped, since a partial brain
+        can only be made from a whole file. Returns False if the import
+        was interrupted.
+        """
+        global _ingest_brain
+
+        filenames = list(filename for filename in filenames if self.progress.get(filename, 0) is not None)
+        for filename in [filename for filename in filenames if self.progress.get(filename, 0)]:
+            if not self.learn_file(borg, filename):
+                return False
+            filenames.remove(filename)
+        self.log.info("I knew %d words (%d lines) before reading %d files with %d processes",
+            borg.brain.num_words, borg.brain.num_lines, len(filenames), jobs)
+
+        _ingest_brain = borg.brain
+        try:
+            pool = multiprocessing.Pool(jobs, ignore_interrupts)
+        finally:
+            _ingest_brain = None
+
+        num_lines = 0
+        start_time = time.time()
+        results = pool.imap_unordered(learn_partial, ((filename, self.log_format) for filename in filenames))
         try:
-            borg.learn(buffer)
-        except KeyboardInterrupt, e:
-            # Close database cleanly
-            print "Premature termination :-("
+            for _ in filenames:
+                # Python 2 only delivers Ctrl-C to a wait with a timeout.
+                while True:
+                    try:
+                        filename, file_lines, lines = results.next(1)
+                        break
+                    except multiprocessing.TimeoutError:
+                        pass
+                merged = borg.brain.merge_lines(lines.itervalues())
+                num_lines += file_lines
+                self.progress[filename] = None
+                if self.checkpoint_lines:
+                    borg.save_all()
+                    self.save_checkpoint()
+                self.log.info("Merged %d distinct lines from %s, read %d lines so far (%.0f lines/s), I know %d words",
+                    merged, filename, num_lines, num_lines / (time.time() - start_time), borg.brain.num_words)
+        except KeyboardInterrupt:
+            pool.terminate()
+            self.save_checkpoint()
+            print "Premature termination :-( Run again with --resume to carry on."
+            return False
+        pool.close()
+        pool.join()
 
-        logging.info("I know %d words (%d lines) now!",
-            borg.settings.num_words, len(borg.brain.lines))
+        self.log.info("I know %d words (%d lines) now! Read %d lines in %.1fs.",
+            borg.brain.num_words, borg.brain.num_lines, num_lines, time.time() - start_time)
+        return True
 
     def shutdown(self):
         pass
@@ -68,11 +266,23 @@ class ModFileIn:
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG)
-    if len(sys.argv) < 2:
-        print "Specify a filename."
-        sys.exit()
+    parser = argparse.ArgumentParser(description="Teach PyBorg from text files (optionally .gz or .bz2 compressed).")
+    parser.add_argument('filenames', metavar='FILE', nargs='+', help="text file to learn from")
+    parser.add_argument('--report-interval', type=float, default=10,
+        help="seconds between progress reports (default %(default)s)")
+    parser.add_argument('--checkpoint', type=int, default=0, metavar='LINES',
+        help="save the brain and a resumable checkpoint every LINES lines (default never)")
+    parser.add_argument('--resume', action='store_true',
+        help="skip what a previous interrupted import already learned")
+    parser.add_argument('-f', '--format', choices=sorted(irclogs.formats), dest='log_format',
+        help="learn what was said in IRC logs of this client instead of from plain text")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help="filter files on this many processes, merging the results (default %(default)s)")
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
 
     my_pyborg = pyborg.Pyborg()
-    ModFileIn(my_pyborg, sys.argv[1:])
+    ModFileIn(my_pyborg, options.filenames, options.report_interval, options.checkpoint, options.resume,
+        options.jobs, options.log_format)
     my_pyborg.save_all()
@@ -39,6 +39,7 @@ IRC._remove_connection = my_remove_connection
 import os
 import pyborg
 import cfgfile
+import metrics
 import random
 import time
 import traceback
@@ -66,6 +67,8 @@ class ModIRC(SingleServerIRCBot):
     owner_mask = []
 
 
+    irc_messages = metrics.counter('pyborg_irc_messages_total', "IRC messages received, by what was done with them", 'action')
+
     # Command list for this module
     commandlist =   "IRC Module Commands:\n!chans, !ignore, \
 !join, !nick, !part, !quit, !quitmsg, !reply2ignored, !replyrate, !shutup, \
@@ -98,28 +101,30 @@ class ModIRC(SingleServerIRCBot):
         self.pyborg = my_pyborg
         # load settings
 
-        self.settings = cfgfile.cfgset()
-        self.settings.load("pyborg-irc.cfg",
-            { "myname": ("The bot's nickname", "PyBorg"),
-              "realname": ("Reported 'real name'", "Pyborg"),
-              "localaddress": ("Local IP to bind to", ""),
-              "ipv6": ("Whether to use IPv6", 0),
-              "owners": ("Owner(s) nickname", [ "OwnerNick" ]),
-              "servers": ("IRC Server to connect to (server, port [,password])", [("irc.starchat.net", 6667)]),
-              "chans": ("Channels to auto-join", ["#test"]),
-              "speaking": ("Allow the bot to talk on channels", 1),
-              "stealth": ("Hide the fact we are a bot", 0),
-              "ignorelist": ("Ignore these nicknames:", []),
-              "reply2ignored": ("Reply to ignored people", 0),
-              "reply_chance": ("Chance of reply (%) per message", 33),
-              "quitmsg": ("IRC quit message", "Bye :-("),
-              "password": ("password for control the bot (Edit manually !)", "")
-            } )
+        self.settings = cfgfile.Settings({
+            "myname": cfgfile.Setting("The bot's nickname", "PyBorg"),
+            "realname": cfgfile.Setting("Reported 'real name'", "Pyborg"),
+            "localaddress": cfgfile.Setting("Local IP to bind to", ""),
+            "ipv6": cfgfile.Setting("Whether to use IPv6", 0),
+            "owners": cfgfile.Setting("Owner(s) nickname", [ "OwnerNick" ]),
+            "servers": cfgfile.Setting("IRC Server to connect to (server, port [,password])", [("irc.starchat.net", 6667)]),
+            "chans": cfgfile.Setting("Channels to auto-join", ["#test"]),
+            "speaking": cfgfile.Setting("Allow the bot to talk on channels", 1),
+            "stealth": cfgfile.Setting("Hide the fact we are a bot", 0),
+            "ignorelist": cfgfile.Setting("Ignore these nicknames:", []),
+            "reply2ignored": cfgfile.Setting("Reply to ignored people", 0),
+            "reply_chance": cfgfile.Setting("Chance of reply (%) per message", 33),
+            "quitmsg": cfgfile.Setting("IRC quit message", "Bye :-("),
+            "password": cfgfile.Setting("password for control the bot (Edit manually !)", ""),
+            "config_poll_interval": cfgfile.Setting("Seconds between checking pyborg.cfg and answers.txt for changes to reload (0 to never)", 5),
+        })
+        self.settings.load("pyborg-irc.cfg")
 
         self.owners = self.settings.owners[:]
         self.chans = self.settings.chans[:]
         self.inchans = []
-        self.wanted_myname = self.settings.myname
+        # Save the nick we want, rather than one we fall back to when it's taken.
+        self.settings.save_overrides['myname'] = self.settings.myname
 
         # Parse command prompt parameters
 
@@ -268,8 +273,9 @@ class ModIRC(SingleServerIRCBot):
                 # Ignore all the other CTCPs
                 return
         # Ignore lines with color
-        if body.find("\x03") != -1: return
-        if body.find("\033") != -1: return
+        if body.find("\x03") != -1 or body.find("\033") != -1:
+            self.irc_messages.inc('ignored_colour')
+            return
 
         #remove special irc fonts chars
         body = re.sub("[\x02\xa0]", "", body)
@@ -284,10 +290,11 @@ class ModIRC(SingleServerIRCBot):
 
         #replace nicknames by "#nick"
         if e.eventtype() == "pubmsg":
-            escaped_users = map(re.escape, self.channels[target].users())
-            # Match nicks on word boundaries to avoid rewriting words incorrectly as containing nicks.
-            p = re.compile(r'\b(' + ('|'.join(escaped_users)) + r')\b')
-            body = p.sub('#nick', body)
+            with self.pyborg.stage_seconds.time('irc_nicks'):
+                escaped_users = map(re.escape, self.channels[target].users())
+                # Match nicks on word boundaries to avoid rewriting words incorrectly as containing nicks.
+                p = re.compile(r'\b(' + ('|'.join(escaped_users)) + r')\b')
+                body = p.sub('#nick', body)
         print body
 
         # Ignore selected nicks
@@ -297,6 +304,7 @@ class ModIRC(SingleServerIRCBot):
             learn = 0
         elif self.settings.ignorelist.count(source.lower()) > 0:
             print "Ignoring %s" % source
+            self.irc_messages.inc('ignored_nick')
             return
 
         # Stealth mode. disable commands for non owners
@@ -310,6 +318,7 @@ class ModIRC(SingleServerIRCBot):
         # Ignore quoted messages
         if body[0] == "<" or body[0:1] == "\"" or body[0:1] == " <":
             print "Ignoring quoted text"
+            self.irc_messages.inc('ignored_quote')
             return
 
         # We want replies reply_chance%, if speaking is on
@@ -325,10 +334,13 @@ class ModIRC(SingleServerIRCBot):
 
             # Parse ModIRC commands
             if body[0] == "!":
-                if self.irc_commands(body, source, target, c, e) == 1:return
+                if self.irc_commands(body, source, target, c, e) == 1:
+                    self.irc_messages.inc('irc_command')
+                    return
 
 
         # Pass message onto pyborg
+        self.irc_messages.inc('processed')
         if source in self.owners and e.source() in self.owner_mask:
             self.pyborg.process_msg(self, body, replyrate, learn, (body, source, target, c, e), owner=1)
         else:
@@ -364,7 +376,7 @@ class ModIRC(SingleServerIRCBot):
                 try:
                     self.connection.nick(command_list[1])
                     self.settings.myname = command_list[1]
-                    self.wanted_myname = self.settings.myname
+                    self.settings.save_overrides['myname'] = self.settings.myname
                 except:
                     pass
             # stealth mode
@@ -506,12 +518,8 @@ class ModIRC(SingleServerIRCBot):
                         phrase = phrase + str(command_list[x]) + " "
                     self.output("\x01ACTION " + phrase + "\x01", ("", command_list[1], "", c, e))
             # Save changes
-            save_myname = self.settings.myname
-            if self.wanted_myname is not None:
-                self.settings.myname = self.wanted_myname
-            self.pyborg.settings.save()
-            self.settings.save()
-            self.settings.myname = save_myname
+            self.pyborg.settings.save_later()
+            self.settings.save_later()
 
         if msg == "":
             return 0
@@ -589,8 +597,10 @@ if __name__ == "__main__":
         print
         sys.exit(0)
     # start the pyborg
-    my_pyborg = pyborg.pyborg()
+    my_pyborg = pyborg.Pyborg()
     bot = ModIRC(my_pyborg, sys.argv)
+    if bot.settings.config_poll_interval:
+        my_pyborg.watch_config(bot.settings.config_poll_interval)
     try:
         bot.our_start()
     except KeyboardInterrupt, e:
@@ -603,5 +613,6 @@ if __name__ == "__main__":
         if c.lower()[:1] == 'n':
             sys.exit(0)
     bot.disconnect(bot.settings.quitmsg)
+    bot.settings.save()
     my_pyborg.save_all()
     del my_pyborg
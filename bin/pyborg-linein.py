@@ -20,6 +20,7 @@
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 #
 
+import argparse
 import logging
 import string
 import sys
@@ -75,8 +76,12 @@ class ModLineIn:
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat with PyBorg offline.")
+    parser.add_argument('--seed', type=int, help="seed for choosing replies, to make them reproducible")
+    options = parser.parse_args()
+
     logging.basicConfig(level=logging.INFO)
-    my_pyborg = pyborg.Pyborg()
+    my_pyborg = pyborg.Pyborg(options.seed)
     try:
         ModLineIn(my_pyborg)
     except SystemExit:
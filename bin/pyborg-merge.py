@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# PyBorg dictionary merge tool
+#
+# Folds the dictionaries of other bots into the one in the current
+# directory.
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+
+import argparse
+import logging
+import marshal
+import sys
+import time
+import zipfile
+
+import pyborg
+
+
+log = logging.getLogger('pyborg-merge')
+
+
+def merge_archive(brain, filename):
+    """
+    Merge the lines of the saved dictionary 'filename' into 'brain'.
+    Only the other brain's lines are read: its word contexts are
+    rebuilt as its lines are merged, and its aliases are undone so
+    our own aliases and censored words apply instead. Counts the other
+    brain has decayed are brought back to what they are worth now.
+    Returns False if the archive can't be merged.
+    """
+    try:
+        zfile = zipfile.ZipFile(filename, 'r')
+        version = zfile.read('version')
+        if version not in (brain.saves_version, "1.1.0"):
+            log.error("%s is version %s but version %s is required. Please convert the dictionary.",
+                filename, version, brain.saves_version)
+            return False
+        lines = marshal.loads(zfile.read('lines.dat'))
+        try:
+            stats = marshal.loads(zfile.read('stats.dat'))
+        except KeyError:
+            stats = {}
+        zfile.close()
+        # Version 1.1.0 keyed the lines by hash(), later versions list them
+        # with None for forgotten lines.
+        if isinstance(lines, dict):
+            lines = lines.values()
+        lines = list(line for line in lines if line is not None)
+        weight = pyborg.decay_weight_since(stats.get('decay_epoch', 0), stats.get('decay_half_life', 0))
+    except (EOFError, IOError, KeyError, ValueError, zipfile.BadZipfile), exc:
+        log.error("Couldn't read dictionary %s: %s", filename, exc)
+        return False
+
+    # Words repeat a lot, so only look at each one once.
+    our_words = {}
+    censored_words = set()
+    for line_text, line_contexts in lines:
+        for word in line_text.split():
+            if word not in our_words:
+                our_word = brain.apply_aliases(word.lstrip('~'))
+                our_words[word] = our_word
+                if brain.is_censored(our_word):
+                    censored_words.add(our_word)
+
+    num_censored = [0]
+
+    def our_lines():
+        for line_text, line_contexts in lines:
+            words = list(our_words[word] for word in line_text.split())
+            if censored_words and not censored_words.isdisjoint(words):
+                num_censored[0] += 1
+                continue
+            yield " ".join(words), line_contexts / weight
+
+    t = time.time()
+    num_lines = brain.num_lines
+    merged = brain.merge_lines(our_lines())
+    log.info("Merged %d lines from %s in %.1fs: %d new, %d censored. %s",
+        merged, filename, time.time() - t, brain.num_lines - num_lines, num_censored[0],
+        brain.known_words())
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Merge other PyBorg dictionaries into the one in the current directory.")
+    parser.add_argument('archives', metavar='ARCHIVE', nargs='+', help="archive.zip of a bot to merge in")
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    my_pyborg = pyborg.Pyborg()
+    if my_pyborg.settings.process_with != "pyborg":
+        log.error("Only pyborg dictionaries can be merged.")
+        sys.exit(1)
+
+    # A merge is a union, so it isn't stopped by our word limit.
+    learning, max_words = my_pyborg.settings.learning, my_pyborg.settings.max_words
+    my_pyborg.settings.learning, my_pyborg.settings.max_words = True, sys.maxint
+    try:
+        ok = all(merge_archive(my_pyborg.brain, filename) for filename in options.archives)
+    finally:
+        my_pyborg.settings.learning, my_pyborg.settings.max_words = learning, max_words
+    if not ok:
+        sys.exit(1)
+
+    my_pyborg.save_all()
@@ -23,6 +23,7 @@
 import collections
 from itertools import izip, count
 import os
+import threading
 
 
 def _load_config(filename):
@@ -40,12 +41,44 @@ def _save_config(filename, fields):
     """
     fields should be a dictionary. Keys as names of
     variables containing tuple (string comment, value).
+    The file is written next to the old one and renamed over
+    it, so readers never see it half written.
     """
-    with open(filename, 'w') as f:
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as f:
         for key, data in sorted(fields.iteritems(), key=lambda f: f[0]):
             comment, value = data
             value_str = repr(value)
             f.write('# {0}\n{1} = {2}\n\n'.format(comment, key, value_str))
+    os.rename(temp_filename, filename)
+
+
+def _stamp(filename):
+    """
+    The modification time and size of a file, to tell if it has
+    been changed, or None if it doesn't exist.
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+def _check_types(defaults, config):
+    """
+    Raise ValueError if a value in 'config' is not the type of its
+    default. Any number will do for a number.
+    """
+    numbers = (bool, int, long, float)
+    for name, value in config.iteritems():
+        default = defaults[name].default
+        if default is None or value is None:
+            continue
+        if isinstance(default, numbers) and isinstance(value, numbers):
+            continue
+        if not isinstance(value, type(default)):
+            raise ValueError("%s should be a %s, not %r" % (name, type(default).__name__, value))
 
 
 Setting = collections.namedtuple('setting', ['comment', 'default'])
@@ -53,10 +86,22 @@ Setting = collections.namedtuple('setting', ['comment', 'default'])
 
 class Settings(object):
 
+    # Seconds save_later() waits, so a burst of changes is written once.
+    save_delay = 5
+
     def __init__(self, defaults):
         self._defaults = defaults
         for key, setting in defaults.iteritems():
             setattr(self, key, setting.default)
+        # The repr of each value as last loaded or saved. Values like
+        # lists are changed in place, so comparing with these is how we
+        # tell what has changed.
+        self._saved = dict()
+        self._save_lock = threading.Lock()
+        self._save_timer = None
+        self._stamp = None
+        # Values to save in place of the current ones, by name.
+        self.save_overrides = dict()
 
     def load(self, filename):
         """
@@ -72,13 +117,71 @@ class Settings(object):
             return
 
         self.__dict__.update(config)
+        # Settings missing from the file count as changed, so they get added.
+        self._saved = dict((name, repr(config[name])) for name in self._defaults if name in config)
+        self._stamp = _stamp(filename)
+
+    def reload(self, validate=None):
+        """
+        Reload the settings changed in the file since we last loaded or
+        saved it, if it has been changed. Settings changed here but not
+        in the file are kept. The new values are checked by 'validate',
+        a function given a dict of them that raises ValueError if any
+        are bad, and then swapped in all at once. Returns the names of
+        the settings changed, raising ValueError if the file is bad.
+        """
+        with self._save_lock:
+            stamp = _stamp(self._filename)
+            if stamp is None or stamp == self._stamp:
+                return []
+            # Don't retry a bad file until it's changed again.
+            self._stamp = stamp
+            try:
+                config = _load_config(self._filename) or dict()
+            except Exception, e:
+                raise ValueError("Couldn't read %s: %s" % (self._filename, e))
+            changes = dict((name, value) for name, value in config.iteritems()
+                if name in self._defaults and repr(value) != self._saved.get(name))
+            _check_types(self._defaults, changes)
+            if validate is not None:
+                validate(changes)
+            self.__dict__.update(changes)
+            for name, value in changes.iteritems():
+                self._saved[name] = repr(value)
+            return sorted(changes)
 
     def save(self):
         """
-        Save borg settings
+        Save borg settings, if any have changed. Returns True if the
+        file was written.
         """
-        keys = dict()
-        for name, default in self._defaults.iteritems():
-            value = getattr(self, name, None)
-            keys[name] = Setting(default.comment, value)
-        _save_config(self._filename, keys)
+        with self._save_lock:
+            keys = dict()
+            saved = dict()
+            for name, default in self._defaults.iteritems():
+                value = self.save_overrides.get(name, getattr(self, name, None))
+                keys[name] = Setting(default.comment, value)
+                saved[name] = repr(value)
+            if saved == self._saved and os.path.exists(self._filename):
+                return False
+            _save_config(self._filename, keys)
+            self._saved = saved
+            self._stamp = _stamp(self._filename)
+            return True
+
+    def save_later(self):
+        """
+        Save the settings in save_delay seconds, along with any other
+        changes made by then.
+        """
+        with self._save_lock:
+            if self._save_timer is not None:
+                return
+            self._save_timer = threading.Timer(self.save_delay, self._save_pending)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def _save_pending(self):
+        with self._save_lock:
+            self._save_timer = None
+        self.save()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#
+# PyBorg: The python AI bot.
+#
+# Parsers for IRC client log files, so PyBorg can learn straight from
+# channel logs.
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+
+import re
+
+
+# Anything that could be a nick, for finding the nicks in a message.
+nick_token_re = re.compile(r'[A-Za-z0-9_\-\[\]\\`^{}|]+')
+
+
+class LogFormat(object):
+    """
+    The shape of one client's log lines. 'joins' match events that
+    tell us someone is on the channel, 'skip' matches other events
+    (parts, modes, topics...), and 'message' and 'action' match what
+    people said. All but 'skip' capture 'nick', and the last two also
+    capture the 'body' of the message.
+    """
+
+    def __init__(self, name, message, action, joins=(), skip=None):
+        self.name = name
+        self.message_re = re.compile(message)
+        self.action_re = re.compile(action)
+        self.join_res = list(re.compile(join) for join in joins)
+        self.skip_re = re.compile(skip) if skip else None
+
+
+_irssi_time = r'^\d\d:\d\d(?::\d\d)? '
+_mirc_time = r'^\[\d\d:\d\d(?::\d\d)?\] '
+_znc_time = r'^\[\d\d:\d\d:\d\d\] '
+_weechat_time = r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\t'
+
+formats = dict((log_format.name, log_format) for log_format in (
+    LogFormat('irssi',
+        message=_irssi_time + r'<[ @+%&~]?(?P<nick>[^>]+)> (?P<body>.*)$',
+        action=_irssi_time + r' \* (?P<nick>\S+) (?P<body>.*)$',
+        joins=(
+            _irssi_time + r'-!- (?P<nick>\S+) \[[^]]*\] has joined ',
+            _irssi_time + r'-!- \S+ is now known as (?P<nick>\S+)',
+        ),
+    ),
+    LogFormat('weechat',
+        message=_weechat_time + r'[@+%&~]?(?P<nick>[^\s\-<>*=][^\t]*)\t(?P<body>.*)$',
+        action=_weechat_time + r' \*\t(?P<nick>\S+) (?P<body>.*)$',
+        joins=(
+            _weechat_time + r'-->\t(?P<nick>\S+) ',
+            _weechat_time + r'--\t\S+ is now known as (?P<nick>\S+)',
+        ),
+    ),
+    LogFormat('znc',
+        message=_znc_time + r'<(?P<nick>[^>]+)> (?P<body>.*)$',
+        action=_znc_time + r'\* (?P<nick>\S+) (?P<body>.*)$',
+        joins=(
+            _znc_time + r'\*\*\* Joins: (?P<nick>\S+)',
+            _znc_time + r'\*\*\* \S+ is now known as (?P<nick>\S+)',
+        ),
+    ),
+    LogFormat('mirc',
+        message=_mirc_time + r'<[@+%&~]?(?P<nick>[^>]+)> (?P<body>.*)$',
+        action=_mirc_time + r'\* (?P<nick>\S+) (?P<body>.*)$',
+        joins=(
+            _mirc_time + r'\* Joins: (?P<nick>\S+)',
+            _mirc_time + r'\* (?P<nick>\S+) has joined ',
+            _mirc_time + r'\* \S+ is now known as (?P<nick>\S+)',
+        ),
+        # mIRC events look like actions, so weed them out first.
+        skip=_mirc_time + r'\* (?:Parts:|Quits:|Now talking|Topic is|Set by|Retrieving|'
+            r'\S+ (?:has left|has quit|sets mode:|was kicked by|changes topic to))',
+    ),
+))
+
+
+def parse_log(lines, log_format):
+    """
+    Generate the messages said in the log 'lines' of 'log_format'
+    (a name in 'formats'), with the nicks of the channel's users
+    replaced by '#nick' like ModIRC.on_msg does. Joins, parts, modes
+    and other events are skipped, as are the lines ModIRC ignores:
+    coloured and quoted text.
+    """
+    log_format = formats[log_format]
+    message_match = log_format.message_re.match
+    action_match = log_format.action_re.match
+    join_res = log_format.join_res
+    skip_re = log_format.skip_re
+
+    # Everyone we've seen on the channel so far.
+    nicks = set()
+
+    def replace_nick(match):
+        token = match.group(0)
+        return '#nick' if token in nicks else token
+
+    for line in lines:
+        line = line.rstrip('\r\n')
+
+        for join_re in join_res:
+            match = join_re.match(line)
+            if match:
+                nicks.add(match.group('nick'))
+                break
+        else:
+            if skip_re is not None and skip_re.match(line):
+                continue
+
+            match = message_match(line)
+            if match:
+                body = match.group('body')
+            else:
+                match = action_match(line)
+                if not match:
+                    continue
+                body = match.group('nick') + " " + match.group('body')
+            nicks.add(match.group('nick'))
+
+            # Ignore lines with color
+            if '\x03' in body or '\033' in body:
+                continue
+            #remove special irc fonts chars
+            body = re.sub("[\x02\xa0]", "", body)
+            # Ignore quoted messages
+            if not body or body[0] == "<" or body[0] == "\"":
+                continue
+
+            yield nick_token_re.sub(replace_nick, body)
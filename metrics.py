@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+#
+# PyBorg: The python AI bot.
+#
+# Cheap counters and latency histograms, reported by the !stats command
+# and optionally served to Prometheus over HTTP on localhost.
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+
+import BaseHTTPServer
+import logging
+import resource
+import threading
+import time
+
+
+log = logging.getLogger('metrics')
+
+# Upper bounds of the latency buckets, in seconds.
+latency_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Every metric created, in order, keyed by name.
+registry = dict()
+_registry_order = list()
+
+
+def _register(metric):
+    if metric.name in registry:
+        return registry[metric.name]
+    registry[metric.name] = metric
+    _registry_order.append(metric)
+    return metric
+
+
+def _labels(label_name, value, **extra):
+    labels = list()
+    if label_name is not None:
+        labels.append((label_name, value))
+    labels.extend(sorted(extra.iteritems()))
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('"', '\\"')) for name, value in labels)
+
+
+class Counter(object):
+    """
+    A count of things that happened, optionally split by the value of
+    one label.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = dict()
+        self.lock = threading.Lock()
+
+    def inc(self, label_value=None, amount=1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.iteritems())
+        for label_value, value in values:
+            yield self.name + _labels(self.label, label_value), value
+
+    def summary(self):
+        with self.lock:
+            values = sorted(self.values.iteritems())
+        if self.label is None:
+            return "%s: %d" % (self.name, sum(value for label_value, value in values))
+        return "%s: %s" % (self.name, ", ".join("%s=%d" % item for item in values))
+
+
+class Gauge(Counter):
+    """
+    A value that goes up and down, like the number of messages being
+    processed.
+    """
+
+    kind = 'gauge'
+
+    def dec(self, label_value=None, amount=1):
+        self.inc(label_value, -amount)
+
+    def set(self, value, label_value=None):
+        with self.lock:
+            self.values[label_value] = value
+
+
+class _Timer(object):
+
+    __slots__ = ('histogram', 'label_value', 'start')
+
+    def __init__(self, histogram, label_value):
+        self.histogram = histogram
+        self.label_value = label_value
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.start, self.label_value)
+
+
+class Histogram(Counter):
+    """
+    A distribution of values (usually seconds) counted into buckets,
+    optionally split by the value of one label.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, label=None, buckets=latency_buckets):
+        super(Histogram, self).__init__(name, help, label)
+        self.buckets = buckets
+
+    def observe(self, value, label_value=None):
+        with self.lock:
+            try:
+                counts, total = self.values[label_value]
+            except KeyError:
+                counts, total = self.values[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    break
+            else:
+                i = len(self.buckets)
+            counts[i] += 1
+            self.values[label_value][1] = total + value
+
+    def time(self, label_value=None):
+        """
+        Time a with block into the histogram.
+        """
+        return _Timer(self, label_value)
+
+    def quantile(self, counts, fraction):
+        """
+        Estimate a quantile from bucket 'counts' as the upper bound of
+        the bucket it falls in.
+        """
+        wanted = fraction * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            seen += count
+            if seen >= wanted and count:
+                return bound
+        return 0.0
+
+    def _snapshot(self):
+        with self.lock:
+            return sorted((label_value, (list(counts), total)) for label_value, (counts, total) in self.values.iteritems())
+
+    def samples(self):
+        for label_value, (counts, total) in self._snapshot():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield self.name + '_bucket' + _labels(self.label, label_value, le=bound), cumulative
+            yield self.name + '_sum' + _labels(self.label, label_value), total
+            yield self.name + '_count' + _labels(self.label, label_value), cumulative
+
+    def summary(self):
+        lines = list()
+        for label_value, (counts, total) in self._snapshot():
+            num = sum(counts)
+            lines.append("%s %s: n=%d mean=%.1fms p50<=%gms p95<=%gms p99<=%gms" % (
+                self.name, label_value if label_value is not None else '', num, total / num * 1000 if num else 0,
+                self.quantile(counts, 0.5) * 1000, self.quantile(counts, 0.95) * 1000,
+                self.quantile(counts, 0.99) * 1000))
+        return "\n".join(lines)
+
+
+def rss():
+    """
+    Resident set size of this process, in bytes.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # Only the peak is available, in kilobytes.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def counter(name, help, label=None):
+    return _register(Counter(name, help, label))
+
+
+def gauge(name, help, label=None):
+    return _register(Gauge(name, help, label))
+
+
+def histogram(name, help, label=None, buckets=latency_buckets):
+    return _register(Histogram(name, help, label, buckets))
+
+
+def render_prometheus():
+    """
+    All the metrics in the Prometheus text exposition format.
+    """
+    lines = list()
+    for metric in _registry_order:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        for name, value in metric.samples():
+            lines.append('%s %r' % (name, value))
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def summary():
+    """
+    A short human readable report of every metric with any values.
+    """
+    return "\n".join(metric.summary() for metric in _registry_order if metric.values)
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render_prometheus()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+def serve(port):
+    """
+    Serve the metrics at http://127.0.0.1:port/metrics from a
+    background thread.
+    """
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), _MetricsHandler)
+    server_thread = threading.Thread(target=server.serve_forever, name='metrics')
+    server_thread.daemon = True
+    server_thread.start()
+    log.info("Serving metrics on http://127.0.0.1:%d/metrics", port)
+    return server
@@ -26,18 +26,75 @@
 
 from __future__ import division
 
+from array import array
+import cProfile
+import gc
+from collections import deque
+import hashlib
+import heapq
 from itertools import count, islice, izip
 import logging
 import marshal    # buffered marshal is bloody fast. wish i'd found this before :)
+import math
 import os
+import pstats
 import random
 import re
+import select
+import signal
 import struct
 import sys
+import threading
 import time
 import zipfile
 
 from cfgfile import Setting, Settings
+import metrics
+
+
+def fork():
+    """
+    os.fork(), holding the logging locks meanwhile so the child doesn't
+    inherit them held by a thread it won't have.
+    """
+    handlers = list(logging.getLogger().handlers)
+    logging._acquireLock()
+    for handler in handlers:
+        handler.acquire()
+    try:
+        return os.fork()
+    finally:
+        for handler in reversed(handlers):
+            handler.release()
+        logging._releaseLock()
+
+
+# A word's context is packed as the ID of a line it's in and its index in
+# the line, in a portable format that doesn't depend on the platform.
+context_struct = struct.Struct('<IH')
+pack_context = context_struct.pack
+unpack_context = context_struct.unpack
+
+
+def build_contexts(lines):
+    """
+    Index the words of 'lines', a list of [sentence, count] (or None)
+    by line ID, returning the words dict of their contexts.
+    """
+    words = dict()
+    for line_id, line in enumerate(lines):
+        if line is None:
+            continue
+        for word_index, word in enumerate(line[0].split()):
+            words.setdefault(word, []).append(pack_context(line_id, word_index))
+    return words
+
+
+# The ways the dictionary can be compressed in archive.zip.
+compression_types = {
+    'deflated': zipfile.ZIP_DEFLATED,
+    'stored': zipfile.ZIP_STORED,
+}
 
 
 def command(fn):
@@ -50,10 +107,164 @@ def owner_command(fn):
     return command(fn)
 
 
+def job_command(fn):
+    """
+    An owner command that takes long, run as a background Job. The
+    command returns a generator doing a chunk of the work each time it
+    is advanced, and yielding a message saying how far it has got, or
+    a message to reply with instead of starting the job.
+    """
+    fn.is_job = True
+    return owner_command(fn)
+
+
+def estimate_size(items, num_items, sample_size, item_size):
+    """
+    Estimate the bytes used by 'num_items' things from the 'item_size'
+    of the first 'sample_size' of 'items'. Dicts iterate in hash
+    order, so the first few are about as good a sample as any.
+    """
+    size = sampled = 0
+    for item in islice(items, sample_size):
+        size += item_size(item)
+        sampled += 1
+    if not sampled:
+        return 0
+    return size * num_items // sampled
+
+
+def decay_weight_since(epoch, half_life):
+    """
+    The weight learning a line has reached 'half_life' days after
+    'epoch', which the counts of lines learned since are scaled by.
+    """
+    if not half_life:
+        return 1
+    return 2 ** ((time.time() - epoch) / (half_life * 86400))
+
+
+def format_bytes(num_bytes):
+    for unit in ('B', 'KB', 'MB'):
+        if num_bytes < 1024:
+            return "%.1f%s" % (num_bytes, unit)
+        num_bytes /= 1024
+    return "%.1fGB" % num_bytes
+
+
+class HeavyHitters(object):
+    """
+    Approximate counts of the most common items in a stream, in fixed
+    memory, by the Space-Saving algorithm: once 'capacity' items are
+    counted, a new item takes over the count of the least counted one.
+    So counts may be too high by as much as the count taken over, but
+    the items seen most stay counted. Items may be added from several
+    threads.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = dict()
+        # (count, item) for each time an item was counted, least first.
+        # Entries for counts since increased are skipped when popped.
+        self.heap = list()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def iteritems(self):
+        """
+        Iterate over a copy of the (item, count) pairs.
+        """
+        with self.lock:
+            return iter(self.counts.items())
+
+    def resize(self, capacity):
+        """
+        Count up to 'capacity' items from now on, forgetting the least
+        counted ones if there are more.
+        """
+        with self.lock:
+            self.capacity = capacity
+            while len(self.counts) > max(capacity, 0):
+                self._evict()
+
+    def add(self, item):
+        with self.lock:
+            self._add(item)
+
+    def _add(self, item):
+        if self.capacity <= 0:
+            return
+        counts = self.counts
+        if item in counts:
+            count = counts[item] + 1
+        elif len(counts) < self.capacity:
+            count = 1
+        else:
+            count = self._evict() + 1
+        counts[item] = count
+        heapq.heappush(self.heap, (count, item))
+        if len(self.heap) > 2 * self.capacity + 100:
+            # Drop the stale entries.
+            self.heap = list((count, item) for item, count in counts.iteritems())
+            heapq.heapify(self.heap)
+
+    def _evict(self):
+        """
+        Forget the least counted item, returning its count.
+        """
+        while True:
+            count, item = heapq.heappop(self.heap)
+            if self.counts.get(item) == count:
+                del self.counts[item]
+                return count
+
+
+class CountMinSketch(object):
+    """
+    Approximate counts of any number of items in fixed memory: each
+    item is counted in one of 'width' counters in each of 'depth' rows,
+    and its count is the least of those, so it may be too high but is
+    never too low. Counters are halved after every 'width' items, so
+    old items are forgotten and the table doesn't fill up.
+    """
+
+    def __init__(self, width=1 << 18, depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = array('I', [0]) * (width * depth)
+        self.num_added = 0
+
+    def add(self, item):
+        """
+        Count 'item' once more, returning its estimated count.
+        """
+        width, table = self.width, self.table
+        indexes = list(row * width + hash((row, item)) % width for row in xrange(self.depth))
+        count = min(table[i] for i in indexes) + 1
+        # Only raising the counters that are too low keeps the other
+        # items sharing them from being overcounted.
+        for i in indexes:
+            if table[i] < count:
+                table[i] = count
+
+        self.num_added += 1
+        if self.num_added >= width:
+            self.table = array('I', (c >> 1 for c in table))
+            self.num_added = 0
+        return count
+
+
 class Brain(object):
 
-    def __init__(self, settings):
+    def __init__(self, settings, rng=None):
         self.settings = settings
+        # All the brain's random choices are made with this, so a seeded
+        # generator gives reproducible replies.
+        self.random = rng if rng is not None else random.Random()
+        # Counts changes to the brain, so we can tell if it needs saving.
+        self.changes = 0
 
     def filter_message(self, message):
         """
@@ -98,94 +309,423 @@ class Brain(object):
     def save(self):
         pass
 
+    def settings_changed(self, names):
+        """
+        Catch up with the settings 'names' having been reloaded.
+        """
+        pass
+
+    def memory_stats(self, sample_size=1000):
+        """
+        Estimate how many bytes each of the brain's structures uses.
+        """
+        return {'bytes': {}}
+
+    def compact_steps(self):
+        """
+        Rebuild the brain's structures at their current size, giving
+        back the room left by what has been forgotten. Each step is
+        done when the generator is advanced, and leaves the brain
+        usable, so messages can be handled in between.
+        """
+        return iter(())
+
+    def needs_compacting(self):
+        """
+        True if enough has been forgotten since the brain was last
+        compacted to make compacting it worthwhile.
+        """
+        return False
+
+    def evict_steps(self):
+        """
+        Forget the least used of what the brain knows to make room, a
+        step at a time like compact_steps().
+        """
+        return iter(())
+
+    def needs_evicting(self):
+        """
+        True if the brain knows more than it should keep.
+        """
+        return False
+
+    def after_reply(self):
+        """
+        Do upkeep put off so as not to delay a reply, once it has been
+        sent.
+        """
+        pass
+
 
 class MegahalBrain(Brain):
 
-    def __init__(self, settings):
-        super(MegahalBrain, self).__init__(settings)
+    def __init__(self, settings, rng=None):
+        super(MegahalBrain, self).__init__(settings, rng)
         import mh_python
 
     def learn(self, body):
+        self.changes += 1
         return mh_python.learn(body)
 
     def reply(self, body):
         return mh_python.doreply(body)
 
 
+class ReplyTrace(object):
+    """
+    A record of how one reply was built: the seed words, each
+    candidate table and draw, and the result.
+    """
+
+    def __init__(self, number, body):
+        self.number = number
+        self.body = body
+        self.time = time.time()
+        self.events = list()
+
+    def seeds(self, word_data, rarest_words):
+        self.events.append(('seeds', (word_data, rarest_words)))
+
+    def draw(self, word, reverse, candidates, draw, total, chosen):
+        self.events.append(('draw', (word, reverse, candidates, draw, total, chosen)))
+
+    def candidate(self, sentence, score):
+        self.events.append(('candidate', (sentence, score)))
+
+    def result(self, sentence):
+        self.events.append(('result', sentence))
+
+    def format(self, max_candidates=None):
+        """
+        The trace as lines of text, showing only the 'max_candidates'
+        heaviest candidates of each draw if given.
+        """
+        lines = ["Trace #%d of reply to %r at %s:" % (self.number, self.body.strip(),
+            time.strftime('%H:%M:%S', time.localtime(self.time)))]
+        for kind, data in self.events:
+            if kind == 'seeds':
+                word_data, rarest_words = data
+                lines.append("  seed words (contexts): %s; rarest: %s" % (
+                    " ".join("%s(%d)" % item for item in word_data), " ".join(rarest_words)))
+            elif kind == 'draw':
+                word, reverse, candidates, draw, total, chosen = data
+                candidates = sorted(candidates.iteritems(), key=lambda (cand_word, contexts): -contexts)
+                shown = candidates[:max_candidates] if max_candidates else candidates
+                table = " ".join("%s:%d" % (cand_word or '<EOL>', contexts) for cand_word, contexts in shown)
+                if len(shown) < len(candidates):
+                    table += " (+%d more)" % (len(candidates) - len(shown))
+                lines.append("  %s %r: drew %d of %d -> %s from %s" % (
+                    "before" if reverse else "after", word, draw, total, chosen or '<EOL>', table))
+            elif kind == 'candidate':
+                sentence, score = data
+                lines.append("  candidate scored %.2f: %s" % (score, " ".join(sentence)))
+            elif kind == 'result':
+                lines.append("  reply: %s" % " ".join(data))
+        return lines
+
+
 class PyborgBrain(Brain):
 
-    saves_version = "1.1.0"
+    saves_version = "1.2.0"
 
     log = logging.getLogger('PyborgBrain')
 
-    def __init__(self, settings):
-        super(PyborgBrain, self).__init__(settings)
+    # Lines whose count has decayed below this are forgotten, a few at a time
+    # as sentences are learned.
+    decayed_count = 1 / 16
+    decay_sweep_chunk = 100
+
+    # Fraction of max_words or max_lines evicted at once, so eviction runs
+    # in occasional batches rather than for every sentence learned.
+    evict_batch = 0.05
+    # The words and lines of the last this many sentences learned aren't
+    # evicted, or what was just learned would be the first to go.
+    evict_spare_recent = 100
+    # At most this fraction of the words and lines left after evicting are
+    # spared, newest first, so eviction can always get under the limits.
+    evict_spare_share = 0.5
+
+    # The brain is worth compacting once this fraction of its lines have
+    # been forgotten, and compact_steps() rebuilds this many context lists
+    # at each step.
+    compact_after = 0.1
+    compact_chunk = 10000
+
+    # Words or lines handled by each chunk of a background job, and
+    # ranked by each chunk of eviction.
+    job_chunk = 1000
+    evict_chunk = 20000
+
+    learn_rejections = metrics.counter('pyborg_learn_rejections_total', "Sentences not learned, by reason", 'reason')
+    evicted = metrics.counter('pyborg_evicted_total', "Words and lines forgotten to make room or because they decayed", 'kind')
+
+    def __init__(self, settings, rng=None):
+        super(PyborgBrain, self).__init__(settings, rng)
 
         self.log.info("Reading dictionary...")
         try:
             zfile = zipfile.ZipFile('archive.zip', 'r')
         except (EOFError, IOError):
-            self.log.debug("No archive.zip found to unarchive")
-        else:
-            # Unarchive all the files from the zip.
-            for filename in zfile.namelist():
-                data = zfile.read(filename)
-                with open(filename, 'w+b') as data_file:
-                    data_file.write(data)
+            self.log.debug("No archive.zip found to read")
+            zfile = None
+
+        def read_member(filename):
+            """
+            Read a file straight from the zip, or from the current directory
+            for dictionaries that were never zipped.
+            """
+            if zfile is not None:
+                try:
+                    return zfile.read(filename)
+                except KeyError:
+                    raise IOError("%s isn't in archive.zip" % filename)
+            with open(filename, 'rb') as data_file:
+                return data_file.read()
 
         try:
-            with open('version', 'rb') as version_file:
-                content = version_file.read()
-            if content != self.saves_version:
+            content = read_member('version')
+            if content not in (self.saves_version, "1.1.0"):
                 self.log.error("Dictionary is version %s but version %s is required. Please convert the dictionary.",
                     content, self.saves_version)
                 # TODO: use an exception here
                 sys.exit(1)
 
-            with open('words.dat', 'rb') as words_file:
-                self.words = marshal.load(words_file)
-            with open('lines.dat', 'rb') as lines_file:
-                self.lines = marshal.load(lines_file)
-        except (EOFError, IOError):
+            self.words = marshal.loads(read_member('words.dat'))
+            self.lines = marshal.loads(read_member('lines.dat'))
+            if content == "1.1.0":
+                self.upgrade_1_1()
+        except (EOFError, IOError, ValueError, zipfile.BadZipfile):
             self.log.info("Couldn't read saved dictionary, so using a new database.")
             self.words = {}
-            self.lines = {}
+            self.lines = []
+
+        # Lines are a list of [sentence, count] indexed by their ID, with
+        # None where a line was forgotten. Those IDs are reused from the
+        # free list, and line_ids finds the ID of a sentence.
+        self.line_ids = {}
+        self.free_lines = []
+        for line_id, line in enumerate(self.lines):
+            if line is None:
+                self.free_lines.append(line_id)
+            else:
+                self.line_ids[line[0]] = line_id
+
+        # How often new words have been seen, when they need to be seen a
+        # few times to be learned.
+        self.probation = None
+
+        # The times each line gave a word to a reply and each word was in
+        # one, kept while evicting to tell which are least used.
+        self.line_uses = {}
+        self.word_uses = {}
+        self.recent_lines = deque(maxlen=self.evict_spare_recent)
+
+        # Lines forgotten since the brain was last compacted.
+        self.forgotten_lines = 0
+        # While !rebuilddict indexes a snapshot of the lines, the sentence
+        # each line changed since had in the snapshot, by line ID.
+        self.rebuild_changes = None
+
+        # Line counts decay relative to this time with this half life,
+        # see decay_weight().
+        self.decay_epoch = time.time()
+        self.decay_half_life = self.settings.decay_half_life
+        # The lines left to check for having decayed away.
+        self.decay_sweep = []
+
+        # Recent ReplyTraces, for !trace.
+        self.traces = deque(maxlen=self.settings.trace_buffer)
+        self.trace_next = False
+        self.num_replies = 0
 
         self.num_words = len(self.words)
-        self.num_contexts = sum(len(line[0].split()) for line in self.lines.itervalues())
 
-        self.log.debug("Checking dictionary for new aliases...")
-        for word in self.words.keys():
-            if word.startswith('~'):
-                if word not in self.settings.aliases:
-                    self.log.debug("Unlearning alias %r", word)
-                    self.unlearn_word(word)
-            else:
-                for alias_word, patterns in self.settings.aliases.iteritems():
-                    for alias_pattern in patterns:
-                        pattern = r'^%s$' % alias_pattern
-                        if re.search(pattern, word):
-                            self.log.debug("Discovered alias %r for word %r, replacing", alias_word, word)
-                            self.replace_word(word, alias_word)
+        # The stats saved with the dictionary let us skip the passes over it
+        # whose inputs haven't changed since it was saved.
+        try:
+            stats = marshal.loads(read_member('stats.dat'))
+        except (EOFError, IOError, ValueError, zipfile.BadZipfile):
+            stats = {}
+        if zfile is not None:
+            zfile.close()
+
+        if stats.get('num_words') == len(self.words) and stats.get('num_lines') == self.num_lines:
+            self.num_contexts = stats['num_contexts']
+        else:
+            t = time.time()
+            self.num_contexts = sum(len(line[0].split()) for line_id, line in self.iterlines())
+            self.log.info("Counted %d contexts in %.2fs", self.num_contexts, time.time() - t)
+
+        self.decay_epoch = stats.get('decay_epoch', self.decay_epoch)
+        self.decay_half_life = stats.get('decay_half_life', self.decay_half_life)
+        # The aliases already applied to the dictionary, so only new ones
+        # need looking for in it.
+        self.applied_aliases = stats.get('applied_aliases')
+        self.update_aliases()
+        self.update_censored()
 
         # Unlearn words in the unlearn.txt file.
         try:
             with open('unlearn.txt', 'r') as unlearn_file:
-                for word in unlearn_file:
-                    word = word.strip()
-                    if word and word in self.words:
-                        self.unlearn_word(word)
+                unlearn_list = unlearn_file.read()
         except (EOFError, IOError):
             # No words to unlearn.
-            pass
+            unlearn_list = ''
+        self.unlearn_list = set(word.strip() for word in unlearn_list.splitlines() if word.strip())
+        self.unlearn_fingerprint = hashlib.md5(unlearn_list).hexdigest()
+        if stats.get('unlearn') == self.unlearn_fingerprint:
+            self.log.debug("unlearn.txt hasn't changed since the dictionary was saved")
+        else:
+            t = time.time()
+            for word in self.unlearn_list:
+                if word in self.words:
+                    self.unlearn_word(word)
+            self.log.info("Unlearned the words in unlearn.txt in %.2fs", time.time() - t)
+
+    def upgrade_1_1(self):
+        """
+        Number the lines of a version 1.1.0 dictionary, which were keyed
+        by their hash(), from 0.
+        """
+        t = time.time()
+        old_lines = self.lines
+        line_ids = dict((line_hash, line_id) for line_id, line_hash in enumerate(old_lines))
+        self.lines = list(old_lines.itervalues())
+        unpack_old_context = struct.Struct('lH').unpack
+        for word, contexts in self.words.iteritems():
+            contexts = (unpack_old_context(context) for context in contexts)
+            self.words[word] = list(pack_context(line_ids[line_hash], word_index)
+                for line_hash, word_index in contexts if line_hash in line_ids)
+        self.log.info("Upgraded the dictionary from version 1.1.0 in %.2fs", time.time() - t)
+
+    @property
+    def num_lines(self):
+        return len(self.lines) - len(self.free_lines)
+
+    def iterlines(self):
+        """
+        Generate the (ID, [sentence, count]) of every line.
+        """
+        for line_id, line in enumerate(self.lines):
+            if line is not None:
+                yield line_id, line
+
+    def add_line(self, line):
+        """
+        Add the [sentence, count] 'line', returning its ID.
+        """
+        if self.free_lines:
+            line_id = self.free_lines.pop()
+            self.line_changing(line_id)
+            self.lines[line_id] = line
+        else:
+            line_id = len(self.lines)
+            self.line_changing(line_id)
+            self.lines.append(line)
+        self.line_ids[line[0]] = line_id
+        return line_id
+
+    def line_changing(self, line_id):
+        """
+        Note that the line 'line_id' is about to change, if a rebuild
+        needs to catch up with it.
+        """
+        changes = self.rebuild_changes
+        if changes is None or line_id in changes:
+            return
+        line = self.lines[line_id] if line_id < len(self.lines) else None
+        changes[line_id] = line[0] if line is not None else None
+
+    def update_aliases(self):
+        """
+        Bring the dictionary up to date with the aliases setting:
+        unlearn the alias words that have been removed and replace the
+        words matching patterns added since the last update with their
+        alias. Patterns already applied aren't looked for again, and
+        the new ones are matched together in a single pass over the
+        words. Returns the number of words replaced.
+        """
+        t = time.time()
+        aliases = self.settings.aliases
+        self._alias_res = list((alias_word, self._compile_patterns(patterns))
+            for alias_word, patterns in aliases.iteritems() if patterns)
+
+        applied = self.applied_aliases
+        if applied is None:
+            # We don't know what was applied, so check everything.
+            applied = {}
+            removed = list(word for word in self.words if word.startswith('~') and word not in aliases)
+        else:
+            removed = list(word for word in applied if word not in aliases and word in self.words)
+        for word in removed:
+            self.log.debug("Unlearning alias %r", word)
+            self.unlearn_word(word)
+
+        new_patterns = list(pattern for alias_word, patterns in aliases.iteritems()
+            for pattern in patterns if pattern not in applied.get(alias_word, ()))
+        replacements = {}
+        if new_patterns:
+            new_re = self._compile_patterns(new_patterns)
+            for word in self.words:
+                if not word.startswith('~') and new_re.match(word):
+                    alias_word = self.apply_aliases(word)
+                    if alias_word != word:
+                        self.log.debug("Discovered alias %r for word %r, replacing", alias_word, word)
+                        replacements[word] = alias_word
+            if replacements:
+                self.replace_words(replacements)
+
+        self.applied_aliases = dict((alias_word, list(patterns)) for alias_word, patterns in aliases.iteritems())
+        if removed or new_patterns:
+            self.log.info("Applied %d new alias patterns in %.2fs: %d words replaced, %d aliases unlearned",
+                len(new_patterns), time.time() - t, len(replacements), len(removed))
+        return len(replacements)
+
+    def update_censored(self):
+        """
+        Compile the censored setting, after it has been changed.
+        """
+        censored = self.settings.censored
+        self._censored_re = self._compile_patterns(censored) if censored else None
+
+    def settings_changed(self, names):
+        if 'aliases' in names:
+            self.update_aliases()
+        if 'censored' in names:
+            self.update_censored()
+
+    def _compile_patterns(self, patterns):
+        """
+        Compile alias or censor patterns into one regex matching the
+        words any of them match in full.
+        """
+        return re.compile('(?:%s)$' % '|'.join('(?:%s)' % pattern for pattern in patterns))
+
+    def saved_stats(self):
+        """
+        Counts and fingerprints of the dictionary's inputs, saved with
+        it so loading can skip the passes they show aren't needed.
+        Words from unlearn.txt learned since startup still need
+        unlearning, so then its fingerprint isn't saved. Also saves the
+        epoch and half life the lines' decaying counts are relative to.
+        """
+        unlearned = not any(word in self.words for word in self.unlearn_list)
+        return {
+            'num_words': len(self.words),
+            'num_lines': self.num_lines,
+            'num_contexts': self.num_contexts,
+            'applied_aliases': self.applied_aliases,
+            'unlearn': self.unlearn_fingerprint if unlearned else None,
+            'decay_epoch': self.decay_epoch,
+            'decay_half_life': self.decay_half_life,
+        }
 
     def apply_aliases(self, word):
-        for repl_word, patterns in self.settings.aliases.iteritems():
-            for pattern in patterns:
-                alias_re = re.compile(r'^%s$' % pattern)
-                if alias_re.match(word):
-                    # We should only care about the first alias, so returning out is fine.
-                    return repl_word
+        for alias_word, alias_re in self._alias_res:
+            if alias_re.match(word):
+                # We should only care about the first alias, so returning out is fine.
+                return alias_word
         return word
 
     def filter_message(self, message):
@@ -203,25 +743,20 @@ class PyborgBrain(Brain):
 
         self.log.info("Writing dictionary...")
 
-        with open('words.dat', 'wb') as words_file:
-            marshal.dump(self.words, words_file)
-        with open('lines.dat', 'wb') as lines_file:
-            marshal.dump(self.lines, lines_file)
-        with open('version', 'w') as version_file:
-            version_file.write(self.saves_version)
-
-        archive = zipfile.ZipFile('archive.zip', 'w', zipfile.ZIP_DEFLATED)
-        archive.write('words.dat')
-        archive.write('lines.dat')
-        archive.write('version')
-        archive.close()
-
         try:
-            os.remove('words.dat')
-            os.remove('lines.dat')
-            os.remove('version')
-        except (OSError, IOError), e:
-            self.log.error("Couldn't remove dictionary files: %s", str(e))
+            compression = compression_types[self.settings.save_compression]
+        except KeyError:
+            raise ValueError("Unknown 'save_compression' value {0}".format(self.settings.save_compression))
+
+        # Write the new archive next to the old one and swap it in, so a
+        # failed save doesn't lose the dictionary.
+        archive = zipfile.ZipFile('archive.zip.new', 'w', compression)
+        archive.writestr('words.dat', marshal.dumps(self.words))
+        archive.writestr('lines.dat', marshal.dumps(self.lines))
+        archive.writestr('stats.dat', marshal.dumps(self.saved_stats()))
+        archive.writestr('version', self.saves_version)
+        archive.close()
+        os.rename('archive.zip.new', 'archive.zip')
 
         # Write out all the words, sorted by number of contexts.
         words = sorted(self.words.keys(), key=lambda w: len(self.words[w]))
@@ -230,31 +765,25 @@ class PyborgBrain(Brain):
                 words_file.write(word)
                 words_file.write('\n')
 
-    def learn_sentence(self, sentence, num_context):
+    def is_censored(self, word):
+        return self._censored_re is not None and self._censored_re.match(word) is not None
+
+    def check_words(self, words):
         """
-        Learn from a sentence.
+        Check the words of a sentence pass the censor and the junk word
+        filters, so the sentence may be learned.
         """
-        words = sentence.split()
-
-        # Ignore empty sentences.
-        # TODO: this used to be sentences with fewer than three words. should it be?
-        if not words:
-            return
-
         all_vowels = u'a\xe0\xe2e\xe9\xe8\xeai\xee\xefo\xf6\xf4u\xfc\xfby'
 
         for word in words:
-            for censored in self.settings.censored:
-                pattern = "^%s$" % censored
-                if re.search(pattern, word):
-                    self.log.debug("Not learning a sentence: word %r is censored", word)
-                    return
-            if not self.settings.learning and word not in self.words:
-                self.log.debug("Not learning a sentence: learning is off and %r is a new word", word)
-                return
+            if self.is_censored(word):
+                self.log.debug("Not learning a sentence: word %r is censored", word)
+                self.learn_rejections.inc('censored')
+                return False
             if len(word) > self.settings.max_word_length:
                 self.log.debug("Not learning a sentence: word %r is too long", word)
-                return
+                self.learn_rejections.inc('too_long')
+                return False
 
             vowels, digits, chars = 0, 0, 0
             for c in word:
@@ -267,29 +796,93 @@ class PyborgBrain(Brain):
 
             if chars and digits:
                 self.log.debug("Not learning a sentence: word %r is mixed alphanumeric", word)
-                return
+                self.learn_rejections.inc('alphanumeric')
+                return False
             if chars and len(word) > 5 and vowels / len(word) < self.settings.min_vowel_ratio:
-                self.log.debug("Not learning a sentence: word %r has too few vowels (%.2f)", word, num_vowels // len(word))
-                return
+                self.log.debug("Not learning a sentence: word %r has too few vowels (%.2f)", word, vowels / len(word))
+                self.learn_rejections.inc('few_vowels')
+                return False
+
+        return True
+
+    def clean_words(self, sentence):
+        """
+        Split a sentence into the words we would learn, with nicks
+        replaced by '#nick'. Returns None if the sentence is empty or
+        fails check_words().
+        """
+        words = sentence.split()
+
+        # Ignore empty sentences.
+        # TODO: this used to be sentences with fewer than three words. should it be?
+        if not words or not self.check_words(words):
+            return None
 
-        words = ['#nick' if '-' in word or '_' in word else word for word in words]
+        return ['#nick' if '-' in word or '_' in word else word for word in words]
 
+    def learn_sentence(self, sentence, num_context):
+        """
+        Learn from a sentence.
+        """
+        words = self.clean_words(sentence)
+        if words is None:
+            return
+
+        if not self.settings.learning:
+            for word in words:
+                if word not in self.words:
+                    self.log.debug("Not learning a sentence: learning is off and %r is a new word", word)
+                    self.learn_rejections.inc('learning_off')
+                    return
+
+        if self.settings.admit_after > 1 and not self.admit(words):
+            return
+        self.learn_words(words, num_context)
+
+    def admit(self, words):
+        """
+        Count each new word of a sentence as seen once more, returning
+        whether they have all been seen 'admit_after' times, so the
+        sentence can be learned. Typos and one-off words never are.
+        """
+        if self.probation is None:
+            self.probation = CountMinSketch()
+        admit_after = self.settings.admit_after
+        admitted = True
+        for word in set(words):
+            if word not in self.words and self.probation.add(word) < admit_after:
+                admitted = False
+        if not admitted:
+            self.log.debug("Not learning a sentence: new words of %r haven't been seen enough", words)
+            self.learn_rejections.inc('probation')
+        return admitted
+
+    def learn_words(self, words, num_context):
+        """
+        Add the line of already cleaned 'words', or count it
+        'num_context' more times if we know it already.
+        """
         try:
             contexts_per_word = self.num_contexts / self.num_words
         except ZeroDivisionError:
             contexts_per_word = 0
 
         clean_sentence = " ".join(words)
+        self.changes += 1
 
-        # Hash collisions we don't care about. 2^32 is big :-)
-        hashval = hash(clean_sentence)
+        weight = self.decay_weight()
+        if weight != 1:
+            num_context *= weight
+            self.sweep_decayed(weight)
 
         # Check context isn't already known
-        if hashval in self.lines:
-            self.lines[hashval][1] += num_context
+        line_id = self.line_ids.get(clean_sentence)
+        if line_id is not None:
+            self.lines[line_id][1] += num_context
+            self.recent_lines.append(line_id)
         # TODO: is this a bug that we can learn until 100 cpw even when "learning" is off?
         elif contexts_per_word <= 100 or self.settings.learning:
-            self.lines[hashval] = [clean_sentence, num_context]
+            line_id = self.add_line([clean_sentence, num_context])
             # Add a link for each word.
             for i, word in enumerate(words):
                 try:
@@ -297,14 +890,90 @@ class PyborgBrain(Brain):
                 except KeyError:
                     self.num_words += 1
                     word_contexts = self.words[word] = list()
-                word_contexts.append(struct.pack("lH", hashval, i))
+                word_contexts.append(pack_context(line_id, i))
                 self.num_contexts += 1
-
+            self.recent_lines.append(line_id)
+
+        if self.settings.evict:
+            # Pyborg evicts in the background once we're over the limits,
+            # but if that falls behind, or we're learning without it, we
+            # evict here.
+            if self.over_limits(1 + self.evict_batch):
+                for step in self.evict_steps():
+                    pass
         # Stop learning when we know enough words.
-        if self.num_words >= self.settings.max_words:
+        elif self.num_words >= self.settings.max_words and self.settings.learning:
             self.log.info("STOP LEARNING: got %d words (max %d)", self.num_words, self.settings.max_words)
             self.settings.learning = False
 
+    def decay_weight(self):
+        """
+        The count learning a line once adds to it now. With
+        decay_half_life set, this doubles every half life, which weighs
+        lines as if all their counts halved, without rewriting them.
+        """
+        half_life = self.settings.decay_half_life
+        if half_life != self.decay_half_life:
+            # The counts were weighted with the old half life, so bring
+            # them to what they are worth now before changing it.
+            self.rebase_decay()
+            self.decay_half_life = half_life
+        weight = decay_weight_since(self.decay_epoch, half_life)
+        if weight > 2 ** 32:
+            # Rebase the counts before they get too big for floats.
+            self.rebase_decay()
+            return 1.0
+        return weight
+
+    def rebase_decay(self):
+        """
+        Divide the line counts by the weight learning has reached, so
+        they count as much as before relative to learning now, and
+        restart decaying from now.
+        """
+        if self.decay_half_life:
+            weight = decay_weight_since(self.decay_epoch, self.decay_half_life)
+            for line_id, line in self.iterlines():
+                line[1] /= weight
+            self.log.info("Rebased the decayed line counts")
+        self.decay_epoch = time.time()
+
+    def sweep_decayed(self, weight):
+        """
+        Check the next decay_sweep_chunk lines of a pass over them all,
+        forgetting those whose count has decayed below decayed_count.
+        """
+        if not self.decay_sweep:
+            self.decay_sweep = self.line_ids.values()
+        chunk = self.decay_sweep[-self.decay_sweep_chunk:]
+        del self.decay_sweep[-self.decay_sweep_chunk:]
+
+        min_count = self.decayed_count * weight
+        lines = self.lines
+        decayed = set(line_id for line_id in chunk if lines[line_id] is not None and lines[line_id][1] < min_count)
+        if decayed:
+            self.forget_lines(decayed)
+            self.evicted.inc('decayed', len(decayed))
+
+    def merge_lines(self, lines):
+        """
+        Merge the [clean sentence, count] 'lines' of a partial brain
+        into this one, summing the counts of lines we already know. The
+        lines are taken as already cleaned and admitted: unlike
+        learn_sentence(), this doesn't check_words() or hold new words
+        back until admit_after, and only skips lines with new words
+        while learning is off. Returns the number of lines merged.
+        """
+        merged = 0
+        for line_text, line_contexts in lines:
+            words = line_text.split()
+            if not self.settings.learning:
+                if any(word not in self.words for word in words):
+                    continue
+            self.learn_words(words, line_contexts)
+            merged += 1
+        return merged
+
     def learn(self, body, num_context=1):
         """
         Lines should be cleaned (filter_message()) before passing
@@ -319,41 +988,209 @@ class PyborgBrain(Brain):
         is a single word then all contexts containing that word
         will be removed, just like the old !unlearn <word>
         """
+        self.forget_lines(self.find_lines(context))
+
+    def find_lines(self, context):
+        """
+        The IDs of the lines containing 'context'.
+        """
         # We need only search lines that contain the words in the context.
         context_words = context.split()
         if not context_words:
             self.log.debug("No words to unlearn!")
-            return
+            return set()
         first_word = context_words[0]
         if first_word not in self.words:
             self.log.debug("Already unlearned all possible contexts for %r", first_word)
-            return
-        lines_to_search = (struct.unpack("lH", ctx)[0] for ctx in self.words[first_word])
+            return set()
+        lines_to_search = (unpack_context(ctx)[0] for ctx in self.words[first_word])
 
         # Pad thing to look for
         # We pad so we don't match 'shit' when searching for 'hit', etc.
         context = " " + context + " "
 
-        words_to_repair = set()
-        for line_hash in lines_to_search:
-            line_text, line_contexts = self.lines[line_hash]
+        lines_to_forget = set()
+        for line_id in lines_to_search:
+            line_text, line_contexts = self.lines[line_id]
             c = " " + line_text + " "
             if c.find(context) != -1:
-                words_to_repair.update(line_text.split())
-                del self.lines[line_hash]
+                lines_to_forget.add(line_id)
+        return lines_to_forget
+
+    def forget_lines(self, line_ids):
+        """
+        Forget the lines 'line_ids', and the words only they had.
+        """
+        self.changes += 1
+        self.forgotten_lines += len(line_ids)
+        lines = self.lines
+        words_to_repair = set()
+        for line_id in line_ids:
+            line_text, line_contexts = lines[line_id]
+            self.line_changing(line_id)
+            lines[line_id] = None
+            self.free_lines.append(line_id)
+            if self.line_ids.get(line_text) == line_id:
+                del self.line_ids[line_text]
+            self.line_uses.pop(line_id, None)
+            words_to_repair.update(line_text.split())
 
         for word in words_to_repair:
             word_contexts = self.words[word]
             num_contexts = len(word_contexts)
-            word_contexts = list(ctx for ctx in word_contexts if struct.unpack("lH", ctx)[0] in self.lines)
+            word_contexts = list(ctx for ctx in word_contexts if lines[unpack_context(ctx)[0]] is not None)
             self.num_contexts -= num_contexts - len(word_contexts)
 
             if word_contexts:
                 self.words[word] = word_contexts
             else:
                 del self.words[word]
+                self.word_uses.pop(word, None)
                 self.num_words -= 1
-                self.log.info("Unlearned all contexts for word %r", word)
+                self.log.debug("Unlearned all contexts for word %r", word)
+
+    def over_limits(self, factor=1):
+        max_lines = self.settings.max_lines
+        return (self.num_words > self.settings.max_words * factor
+            or (max_lines and self.num_lines > max_lines * factor))
+
+    def needs_evicting(self):
+        return self.settings.evict and self.over_limits()
+
+    def evict_steps(self):
+        """
+        Forget the least used words and lines until we're a batch under
+        max_words and max_lines. Words are valued by their contexts and
+        the times they were in replies, lines by the times they were
+        learned and the times they gave a word to a reply. Those of the
+        sentences learned last are spared, up to evict_spare_share of
+        what is kept. They are ranked, and then forgotten, a chunk at a
+        time.
+        """
+        t = time.time()
+        num_words, num_lines = self.num_words, self.num_lines
+        max_words, max_lines = self.settings.max_words, self.settings.max_lines
+
+        lines = self.lines
+        max_spared_words = int(max_words * (1 - self.evict_batch) * self.evict_spare_share)
+        max_spared_lines = (int(max_lines * (1 - self.evict_batch) * self.evict_spare_share) if max_lines
+            else len(self.recent_lines))
+        spared_lines = set()
+        spared_words = set()
+        for line_id in reversed(self.recent_lines):
+            if line_id >= len(lines) or lines[line_id] is None:
+                continue
+            words = spared_words.union(lines[line_id][0].split())
+            if len(words) > max_spared_words or len(spared_lines) >= max_spared_lines:
+                break
+            spared_lines.add(line_id)
+            spared_words = words
+
+        if self.num_words > max_words:
+            excess = self.num_words - int(max_words * (1 - self.evict_batch))
+            # The most used of the least used words so far is on top.
+            least_used = []
+            words = self.words.keys()
+            for start in xrange(0, len(words), self.evict_chunk):
+                yield "Ranked %d of %d words" % (start, len(words))
+                word_uses = self.word_uses
+                for word in words[start:start + self.evict_chunk]:
+                    contexts = self.words.get(word)
+                    if contexts is None or word in spared_words:
+                        continue
+                    value = len(contexts) + word_uses.get(word, 0)
+                    if len(least_used) < excess:
+                        heapq.heappush(least_used, (-value, word))
+                    elif value < -least_used[0][0]:
+                        heapq.heapreplace(least_used, (-value, word))
+            lines = self.lines
+            found = set(unpack_context(context)[0] for value, word in least_used
+                for context in self.words.get(word, ()))
+            found = list((line_id, lines[line_id]) for line_id in found)
+            for forgotten in self.forget_found_lines(found):
+                yield "Forgot %d of %d lines of the least used words" % (forgotten, len(found))
+
+        if max_lines and self.num_lines > max_lines:
+            excess = self.num_lines - int(max_lines * (1 - self.evict_batch))
+            least_used = []
+            for start in xrange(0, len(self.lines), self.evict_chunk):
+                yield "Ranked %d of %d lines" % (start, len(self.lines))
+                lines, line_uses = self.lines, self.line_uses
+                weight = self.decay_weight()
+                for line_id in xrange(start, min(start + self.evict_chunk, len(lines))):
+                    line = lines[line_id]
+                    if line is None or line_id in spared_lines:
+                        continue
+                    value = line[1] / weight + line_uses.get(line_id, 0)
+                    if len(least_used) < excess:
+                        heapq.heappush(least_used, (-value, line_id, line))
+                    elif value < -least_used[0][0]:
+                        heapq.heapreplace(least_used, (-value, line_id, line))
+            found = list((line_id, line) for value, line_id, line in least_used)
+            for forgotten in self.forget_found_lines(found):
+                yield "Forgot %d of %d least used lines" % (forgotten, len(found))
+
+        self.discard_reply_pool()
+        self.evicted.inc('words', num_words - self.num_words)
+        self.evicted.inc('lines', num_lines - self.num_lines)
+        yield "Evicted %d words and %d lines in %.2fs" % (num_words - self.num_words,
+            num_lines - self.num_lines, time.time() - t)
+
+    def forget_found_lines(self, found):
+        """
+        Forget the (ID, line) pairs 'found', job_chunk at a time, except
+        those forgotten since they were found, whose IDs may have been
+        reused. Generates the number forgotten so far after each chunk.
+        """
+        forgotten = 0
+        for start in xrange(0, len(found), self.job_chunk):
+            lines = self.lines
+            line_ids = set(line_id for line_id, line in found[start:start + self.job_chunk]
+                if line_id < len(lines) and lines[line_id] is line)
+            self.forget_lines(line_ids)
+            forgotten += len(line_ids)
+            yield forgotten
+
+    def compact_steps(self):
+        """
+        CPython's dicts and lists keep the size they grew to when things
+        are removed from them, so rebuild them: trim the forgotten lines
+        off the end of the lines list, copy the dicts into tables sized
+        for what they hold, intern the words, and copy each word's
+        contexts into a list without room to grow, compact_chunk words
+        per step.
+        """
+        lines = self.lines
+        while lines and lines[-1] is None:
+            lines.pop()
+        self.free_lines = list(line_id for line_id in self.free_lines if line_id < len(lines))
+        self.lines = list(lines)
+        # The pass may have been over lines that were trimmed.
+        self.decay_sweep = []
+        self.forgotten_lines = 0
+        yield
+
+        self.line_ids = dict(self.line_ids)
+        self.line_uses = dict(self.line_uses)
+        yield
+
+        self.words = dict((intern(word) if type(word) is str else word, contexts)
+            for word, contexts in self.words.iteritems())
+        self.word_uses = dict((intern(word) if type(word) is str else word, uses)
+            for word, uses in self.word_uses.iteritems())
+        yield
+
+        words = self.words.keys()
+        for start in xrange(0, len(words), self.compact_chunk):
+            for word in words[start:start + self.compact_chunk]:
+                contexts = self.words.get(word)
+                if contexts is not None:
+                    self.words[word] = list(contexts)
+            yield
+        self.discard_reply_pool()
+
+    def needs_compacting(self):
+        return self.forgotten_lines > self.compact_after * max(len(self.lines), 1)
 
     def reply(self, body):
         """
@@ -382,25 +1219,68 @@ class PyborgBrain(Brain):
         rarest_words = list(word for word, contexts in word_data if contexts == fewest_contexts)
         self.log.debug("Rarest words with %d contexts: %r", fewest_contexts, rarest_words)
 
+        trace = self.start_trace(body)
+        if trace is not None:
+            trace.seeds(word_data, rarest_words)
+
         # Index now contains list of rarest known words in sentence
-        word = random.choice(rarest_words)
-        self.log.debug("Selected seed word: %r", word)
+        if self.settings.reply_candidates > 1:
+            sentence = self.best_reply(rarest_words, words, trace)
+        else:
+            word = self.random.choice(rarest_words)
+            self.log.debug("Selected seed word: %r", word)
+            sentence = self.build_reply(word, trace)
+        self.log.debug("So sentence is %r!", sentence)
+        if trace is not None:
+            trace.result(sentence)
+        if self.settings.evict:
+            for word in sentence:
+                self.word_uses[word] = self.word_uses.get(word, 0) + 1
+
+        # Clean up aliases.
+        sentence = (word.lstrip('~') for word in sentence)
+
+        result_sentence = ' '.join(sentence)
+
+        punctuation_fixups = {
+            " ' ": "'",
+            ' ?': '?',
+            ' !': '!',
+            ' ,': ',',
+        }
+        for punct_from, punct_to in punctuation_fixups.iteritems():
+            result_sentence = result_sentence.replace(punct_from, punct_to)
+
+        return result_sentence
+
+    def build_reply(self, word, trace=None):
+        """
+        Build a reply sentence (as a list of words) outwards from
+        the seed 'word' with the markov chain, recording each choice
+        in the ReplyTrace 'trace' if given.
+        """
+        lines = self.lines
+        line_uses = self.line_uses if self.settings.evict else None
 
         def choose_words(sentence, reverse=False):
             search_direction = -1 if reverse else 1
 
             sentence = list(reversed(sentence)) if reverse else list(sentence)
-            EOL = object()
+            # split() never gives an empty word, so it can stand for the end of
+            # the line. Unlike object(), it hashes the same every run, so a
+            # seeded self.random picks the same candidates.
+            EOL = ''
             while True:
                 # create a dictionary wich will contain all the words we can found before the "chosen" word
                 candidate_words = { EOL: 0 }
+                # The last line to nominate each word.
+                candidate_lines = {}
 
+                # This loop is the hottest in the bot, so it doesn't log: use traces to see inside it.
                 this_word = sentence[-1]
-                self.log.debug("Examining candidates to follow word %r in %d contexts",
-                    this_word, len(self.words[this_word]))
                 for context in self.words[this_word]:
-                    line_hash, word_index = struct.unpack("lH", context)
-                    line, num_contexts = self.lines[line_hash]
+                    line_id, word_index = unpack_context(context)
+                    line, num_contexts = lines[line_id]
                     line_words = line.split()
 
                     assert line_words[word_index] == this_word, 'Inconsistent context %r thought word %r was #%d' % (
@@ -413,13 +1293,11 @@ class PyborgBrain(Brain):
                         cand_word = line_words[cand_index]
                     except IndexError:
                         # The seed word is at the end of the line, so nominate the EOL.
-                        self.log.debug("Found current word %r at the end of line %r, so nominating EOL", this_word, line)
                         candidate_words[EOL] += num_contexts
                         continue
 
                     # Don't nominate a word that's already in the sentence.
                     if cand_word in sentence:
-                        self.log.debug("Skipping candidate word %r: already in the sentence", cand_word)
                         continue
 
                     # Does the *previous* word in the candidate word's sentence *also* match?
@@ -431,31 +1309,36 @@ class PyborgBrain(Brain):
                         following_word_matches = sentence[-2] == line_words[following_line_index]
                     except IndexError:
                         # Either the seed sentence or the candidate line are too short to consider the next word, but that's okay.
-                        self.log.debug("Couldn't determine if candidate word %r has a run-of-2, so benefitting its doubt",
-                            cand_word)
+                        pass
                     else:
                         # If there *are* following words to compare at all, require they match.
                         if following_word_matches:
-                            self.log.debug("Skipping candidate word %r: previous word is %r, but wanted %r",
-                                cand_word, line_words[word_index - search_direction], sentence[-2])
                             continue
 
                     candidate_words[cand_word] = candidate_words.get(cand_word, 0) + num_contexts
-                    self.log.debug("Yay, candidate word %r up to %d contexts!", cand_word, candidate_words[cand_word])
-
-                self.log.debug("From seed word %r, discovered candidates: %r", this_word, candidate_words)
+                    candidate_lines[cand_word] = line_id
 
                 # Randomly select an unused candidate word, weighted by number of contexts.
                 total_contexts = sum(candidate_words.values())
-                selection = random.randint(0, total_contexts)
+                if isinstance(total_contexts, float):
+                    # Decayed counts.
+                    draw = selection = self.random.uniform(0, total_contexts)
+                else:
+                    draw = selection = self.random.randint(0, total_contexts)
                 for cand_word, cand_contexts in candidate_words.iteritems():
                     selection -= cand_contexts
                     if selection <= 0:
                         break
 
+                if trace is not None:
+                    trace.draw(this_word, reverse, candidate_words, draw, total_contexts, cand_word)
+
                 selected_word = cand_word
-                if selected_word is EOL:
+                if selected_word == EOL:
                     break
+                if line_uses is not None:
+                    line_id = candidate_lines[cand_word]
+                    line_uses[line_id] = line_uses.get(line_id, 0) + 1
 
                 sentence.append(cand_word)
 
@@ -464,65 +1347,328 @@ class PyborgBrain(Brain):
             return sentence
 
         pre_words = choose_words([word], reverse=True)
-        self.log.debug("Chose left reply: %r", pre_words)
         post_words = choose_words(pre_words[-2:])
-        self.log.debug("Chose right reply from %r end of left: %r", pre_words[-2:], post_words)
-        sentence = pre_words[:-2] + post_words
-        self.log.debug("So sentence is %r!", sentence)
+        return pre_words[:-2] + post_words
 
-        # Clean up aliases.
-        sentence = (word.lstrip('~') for word in sentence)
+    def score_reply(self, sentence, input_words=()):
+        """
+        Score a candidate reply by how surprising its words are,
+        using the context counts we already have: rare words carry
+        more information than common ones. Words the reply merely
+        echoes from the input don't count. Long replies are
+        penalised like MegaHAL does, so rambling doesn't win.
+        """
+        total_contexts = self.num_contexts or 1
+        surprise = 0.0
+        for word in sentence:
+            if word in input_words:
+                continue
+            word_contexts = len(self.words.get(word, ()))
+            if word_contexts:
+                surprise += math.log(total_contexts / word_contexts)
 
-        result_sentence = ' '.join(sentence)
+        if len(sentence) > 8:
+            surprise /= math.sqrt(len(sentence) - 1)
+        if len(sentence) > 16:
+            surprise /= len(sentence)
+        return surprise
 
-        punctuation_fixups = {
-            " ' ": "'",
-            ' ?': '?',
-            ' !': '!',
-            ' ,': ',',
-        }
-        for punct_from, punct_to in punctuation_fixups.iteritems():
-            result_sentence = result_sentence.replace(punct_from, punct_to)
+    def best_reply(self, seed_words, input_words=(), trace=None):
+        """
+        Generate up to 'reply_candidates' replies from random seeds
+        among 'seed_words' within 'reply_budget' seconds and return
+        the one with the best score_reply(). Candidates built on the
+        reply pool can't be traced, only their scores.
+        """
+        deadline = time.time() + self.settings.reply_budget
+        num_candidates = self.settings.reply_candidates
+
+        candidates = None
+        if 0 < self.settings.reply_pool_min_words <= self.num_words:
+            candidates = self._pool_candidates(seed_words, num_candidates, deadline)
+        if not candidates:
+            candidates = _generate_candidates(self, seed_words, num_candidates, deadline, trace)
+
+        input_words = frozenset(input_words)
+        scored = list((self.score_reply(sentence, input_words), sentence) for sentence in candidates)
+        self.log.debug("Scored %d reply candidates: %r", len(scored), scored)
+        if trace is not None:
+            for score, sentence in scored:
+                trace.candidate(sentence, score)
+        return max(scored)[1]
+
+    def _pool_candidates(self, seed_words, num_candidates, deadline):
+        """
+        Generate candidates on the reply pool, splitting them between
+        the worker processes. Returns None if there is no pool yet.
+        """
+        pool = getattr(self, '_reply_pool', None)
+        if pool is None:
+            return None
 
-        return result_sentence
+        num_workers = self._reply_pool_workers
+        per_worker = -(-num_candidates // num_workers)
+        tasks = list(pool.apply_async(_pool_generate, (seed_words, per_worker, deadline, self.random.getrandbits(32)))
+            for i in xrange(num_workers))
+
+        candidates = list()
+        for task in tasks:
+            try:
+                candidates.extend(task.get(max(deadline - time.time(), 0) + 0.05))
+            except Exception, exc:
+                self.log.debug("Reply pool task failed or ran out of time: %r", exc)
+        return candidates
+
+    def after_reply(self):
+        """
+        Start the process pool for generating replies, or recycle it.
+        The workers generate from a copy-on-write snapshot of the brain
+        taken when they were forked, so the pool is recycled once the
+        brain has changed noticeably since then. Done after a reply is
+        sent, so forking doesn't add to its latency.
+        """
+        global _pool_brain
+
+        if not 0 < self.settings.reply_pool_min_words <= self.num_words:
+            return
+        pool = getattr(self, '_reply_pool', None)
+        if pool is not None:
+            drift = abs(self.num_contexts - self._reply_pool_contexts)
+            if drift <= self._reply_pool_contexts // 100:
+                return
+            self.discard_reply_pool()
+
+        try:
+            import multiprocessing
+            num_workers = multiprocessing.cpu_count()
+            _pool_brain = self
+            try:
+                self._reply_pool = multiprocessing.Pool(num_workers)
+            finally:
+                _pool_brain = None
+        except (ImportError, NotImplementedError, OSError), exc:
+            self.log.warning("Couldn't start the reply pool, generating replies inline: %s", exc)
+            self.settings.reply_pool_min_words = 0
+            return
+        self._reply_pool_workers = num_workers
+        self._reply_pool_contexts = self.num_contexts
+
+    def discard_reply_pool(self):
+        """
+        Shut down the reply pool, so workers are forked with the
+        current brain after the next reply.
+        """
+        pool = getattr(self, '_reply_pool', None)
+        if pool is not None:
+            pool.terminate()
+            self._reply_pool = None
+
+    def catch_up_contexts(self, words, changes):
+        """
+        Bring 'words', indexed from a snapshot of the lines, up to date
+        with the lines changed since. 'changes' maps the ID of each of
+        them to the sentence it had in the snapshot, or None.
+        """
+        lines = self.lines
+        stale = {}
+        for line_id, old_text in changes.iteritems():
+            if old_text is not None:
+                for word_index, word in enumerate(old_text.split()):
+                    stale.setdefault(word, set()).add(pack_context(line_id, word_index))
+        for word, stale_contexts in stale.iteritems():
+            contexts = list(context for context in words[word] if context not in stale_contexts)
+            if contexts:
+                words[word] = contexts
+            else:
+                del words[word]
+
+        for line_id in changes:
+            line = lines[line_id] if line_id < len(lines) else None
+            if line is not None:
+                for word_index, word in enumerate(line[0].split()):
+                    words.setdefault(word, []).append(pack_context(line_id, word_index))
+
+    def swap_contexts(self, words):
+        """
+        Replace the words dict with 'words', rebuilt from the lines.
+        """
+        self.words = words
+        self.num_words = len(words)
+        self.num_contexts = sum(len(contexts) for contexts in words.itervalues())
+        self.word_uses = dict((word, uses) for word, uses in self.word_uses.iteritems() if word in words)
+        self.discard_reply_pool()
+        self.changes += 1
 
     def replace_word(self, old_word, new_word):
         """
         Replace all occuraces of 'old' in the dictionary with
         'new'. Nice for fixing learnt typos.
         """
-        try:
-            contexts = self.words[old_word]
-        except KeyError:
-            return old + " not known."
+        if old_word not in self.words:
+            return old_word + " not known."
+        changed = self.replace_words({old_word: new_word})
+        return "%d instances of %s replaced with %s" % (changed, old_word, new_word)
+
+    def replace_words(self, replacements):
+        """
+        Replace every occurance of each word in the dict 'replacements'
+        with the word it maps to, rewriting each line they're in once.
+        The new words mustn't be replaced themselves. A line that comes
+        to read the same as a known one is merged into it. Returns the
+        number of contexts changed.
+        """
+        line_edits = {}
+        for old_word, new_word in replacements.iteritems():
+            for context in self.words[old_word]:
+                line_id, word_index = unpack_context(context)
+                line_edits.setdefault(line_id, []).append((word_index, old_word, new_word))
+
+        merged = {}
+        for line_id, edits in line_edits.iteritems():
+            self.line_changing(line_id)
+            line = self.lines[line_id]
+            line_words = line[0].split()
+            for word_index, old_word, new_word in edits:
+                assert line_words[word_index] == old_word, 'Inconsistent context %r thought word %r was #%d' % (
+                    line_id, old_word, word_index)
+                line_words[word_index] = new_word
+            if self.line_ids.get(line[0]) == line_id:
+                del self.line_ids[line[0]]
+            line[0] = " ".join(line_words)
+            known_id = self.line_ids.setdefault(line[0], line_id)
+            if known_id != line_id:
+                # The sentence is known already, so it takes this line's
+                # count and uses, and the slot is freed.
+                self.lines[known_id][1] += line[1]
+                uses = self.line_uses.pop(line_id, 0)
+                if uses:
+                    self.line_uses[known_id] = self.line_uses.get(known_id, 0) + uses
+                self.lines[line_id] = None
+                self.free_lines.append(line_id)
+                merged[line_id] = line[0]
+        self.discard_reply_pool()
+        self.changes += 1
+
         changed = 0
+        for old_word, new_word in replacements.iteritems():
+            contexts = self.words.pop(old_word)
+            changed += len(contexts)
+            if new_word in self.words:
+                self.num_words -= 1
+                self.words[new_word].extend(contexts)
+            else:
+                self.words[new_word] = contexts
 
-        for context in contexts:
-            line_hash, word_index = struct.unpack("lH", context)
-            line_text, line_contexts = self.lines[line_hash]
-            line_words = line_text.split()
+        # The contexts of a merged line point to the same words of the line
+        # it was merged into, which has contexts of its own for them.
+        if merged:
+            words_to_repair = set()
+            for line_text in merged.itervalues():
+                words_to_repair.update(line_text.split())
+            for word in words_to_repair:
+                contexts = self.words[word]
+                kept = list(context for context in contexts if unpack_context(context)[0] not in merged)
+                self.num_contexts -= len(contexts) - len(kept)
+                self.words[word] = kept
+        return changed
+
+    def memory_stats(self, sample_size=1000):
+        """
+        Estimate the bytes used by the words dict (the table, the words
+        and their context lists), the packed contexts in those lists and
+        the lines and their index, by sampling 'sample_size' entries of each. Also
+        gives percentiles of contexts per word, and the heaviest words.
+        """
+        getsizeof = sys.getsizeof
 
-            assert line_words[word_index] == old_word, 'Inconsistent context %r thought word %r was #%d' % (
-                line_hash, old_word, word_index)
+        def word_size((word, contexts)):
+            return getsizeof(word) + getsizeof(contexts)
 
-            line_words[word_index] = new_word
-            line_text = " ".join(line_words)
-            self.lines[line_hash][0] = line_text
-            changed += 1
+        def contexts_size(contexts):
+            return sum(getsizeof(context) for context in contexts)
 
-        if new_word in self.words:
-            self.num_words -= 1
-            self.words[new_word].extend(self.words[old_word])
-        else:
-            self.words[new_word] = self.words[old_word]
-        del self.words[old_word]
+        def line_size((line_id, line)):
+            return getsizeof(line) + getsizeof(line[0]) + getsizeof(line[1])
 
-        return "%d instances of %s replaced with %s" % (changed, old_word, new_word)
+        num_words, num_lines = len(self.words), self.num_lines
+        sizes = {
+            'words': getsizeof(self.words) + estimate_size(self.words.iteritems(), num_words, sample_size, word_size),
+            'contexts': estimate_size(self.words.itervalues(), num_words, sample_size, contexts_size),
+            'lines': getsizeof(self.lines) + getsizeof(self.line_ids) + getsizeof(self.free_lines)
+                + estimate_size(self.iterlines(), num_lines, sample_size, line_size),
+        }
+        if self.probation is not None:
+            sizes['probation'] = getsizeof(self.probation.table)
+        if self.line_uses or self.word_uses:
+            sizes['uses'] = (getsizeof(self.line_uses) + getsizeof(self.word_uses)
+                + (len(self.line_uses) + len(self.word_uses)) * getsizeof(0))
+
+        context_counts = sorted(len(contexts) for contexts in self.words.values())
+        percentiles = dict()
+        if context_counts:
+            for percent in (50, 90, 99, 100):
+                percentiles[percent] = context_counts[min(len(context_counts) * percent // 100, len(context_counts) - 1)]
+
+        heaviest = heapq.nlargest(10, self.words.iteritems(), key=lambda (word, contexts): len(contexts))
+        heaviest = list((word, len(contexts), word_size((word, contexts)) + contexts_size(contexts))
+            for word, contexts in heaviest)
+
+        return {
+            'bytes': sizes,
+            'contexts_per_word': percentiles,
+            'heaviest_words': heaviest,
+        }
+
+    def start_trace(self, body):
+        """
+        Return a ReplyTrace to record the reply to 'body' in if the
+        owner asked for it or it's one of the 1 in 'trace_sample_rate'
+        replies sampled, otherwise None.
+        """
+        self.num_replies += 1
+        rate = self.settings.trace_sample_rate
+        if not (self.trace_next or (rate and not self.num_replies % rate)):
+            return None
+        self.trace_next = False
+        if self.traces.maxlen != self.settings.trace_buffer:
+            self.traces = deque(self.traces, self.settings.trace_buffer)
+        trace = ReplyTrace(self.num_replies, body)
+        self.traces.append(trace)
+        return trace
+
+    @owner_command
+    def trace(self, io_module, command_args, args):
+        traces = list(self.traces)
+        action = command_args[0].lower() if command_args else None
+        if action == 'next':
+            self.trace_next = True
+            return "I'll trace my next reply."
+        if action == 'clear':
+            self.traces.clear()
+            return "Cleared %d traces." % len(traces)
+        if not traces:
+            return "No replies traced. Use !trace next, or set trace_sample_rate."
+        if action == 'dump':
+            with open('traces.txt', 'a') as traces_file:
+                for trace in traces:
+                    for line in trace.format():
+                        traces_file.write(line)
+                        traces_file.write('\n')
+                    traces_file.write('\n')
+            return "Wrote %d traces to traces.txt." % len(traces)
+        if action == 'show':
+            try:
+                number = int(command_args[1]) if len(command_args) > 1 else traces[-1].number
+                trace = (trace for trace in traces if trace.number == number).next()
+            except (ValueError, StopIteration):
+                return "No such trace."
+            return "\n".join(trace.format(max_candidates=8))
+        return "Traced replies: " + ", ".join("#%d %r" % (trace.number, trace.body.strip()) for trace in traces)
 
     def known_words(self):
         num_w = self.num_words
         num_c = self.num_contexts
-        num_l = len(self.lines)
+        num_l = self.num_lines
         if num_w != 0:
             num_cpw = num_c / float(num_w)  # contexts per word
         else:
@@ -553,19 +1699,25 @@ class PyborgBrain(Brain):
         self.settings.max_words = int(command_args[0].lower())
         return "Set the max word limit to %d words." % self.settings.max_words
 
-    @owner_command
+    @job_command
     def checkdict(self, io_module, command_args, args):
         t = time.time()
         num_broken = 0
         num_bad = 0
-        for w in self.words.keys():
-            wlist = self.words[w]
+        words = self.words.keys()
+        for num_checked, w in enumerate(words):
+            if num_checked % self.job_chunk == 0:
+                yield "Checked %d of %d words" % (num_checked, len(words))
+            # The word may have been forgotten since we started.
+            wlist = self.words.get(w)
+            if wlist is None:
+                continue
 
             for i in xrange(len(wlist) - 1, -1, -1):
-                line_idx, word_num = struct.unpack("lH", wlist[i])
+                line_idx, word_num = unpack_context(wlist[i])
 
                 # Nasty critical error we should fix
-                if not self.lines.has_key(line_idx):
+                if line_idx >= len(self.lines) or self.lines[line_idx] is None:
                     print "Removing broken link '%s' -> %d" % (w, line_idx)
                     num_broken = num_broken + 1
                     del wlist[i]
@@ -582,35 +1734,87 @@ class PyborgBrain(Brain):
                 self.num_words -= 1
                 print "\"%s\" vaped totally" % w
 
-        return "Checked dictionary in %0.2fs. Fixed links: %d broken, %d bad." % \
+        yield "Checked dictionary in %0.2fs. Fixed links: %d broken, %d bad." % \
             (time.time() - t, num_broken, num_bad)
 
-    @owner_command
+    @job_command
     def rebuilddict(self, io_module, command_args, args):
-        # Rebuild the dictionary by discarding the word links and
-        # re-parsing each line
-        if not self.settings.learning:
-            return "Not learning, so not rebuilding."
-
+        # Rebuild the word links from the lines as they are, so their
+        # counts are kept and they aren't filtered again.
         t = time.time()
-
-        old_lines = self.lines.values()
         old_num_words = self.num_words
         old_num_contexts = self.num_contexts
 
-        self.words = {}
-        self.lines = {}
-        self.num_words = 0
-        self.num_contexts = 0
-
-        for line_text, line_contexts in old_lines:
-            self.learn(line_text, line_contexts)
-
-        return "Rebuilt dictionary in %0.2fs. Words %d (%+d), contexts %d (%+d)" % (
+        if not hasattr(os, 'fork'):
+            self.swap_contexts(build_contexts(self.lines))
+        else:
+            num_lines = self.num_lines
+            read_fd, write_fd = os.pipe()
+            running = False
+            try:
+                try:
+                    pid = fork()
+                except OSError, e:
+                    yield "Couldn't start a process to rebuild the dictionary: %s" % e
+                    return
+                if pid == 0:
+                    status = 1
+                    try:
+                        os.close(read_fd)
+                        with os.fdopen(write_fd, 'wb') as pipe:
+                            pipe.write(marshal.dumps(build_contexts(self.lines)))
+                        status = 0
+                    except Exception:
+                        self.log.exception("Rebuilding the dictionary failed")
+                    finally:
+                        os._exit(status)
+
+                # The worker indexes a snapshot of the lines, so note the
+                # lines changed from now on to catch up with them.
+                running = True
+                self.rebuild_changes = {}
+                os.close(write_fd)
+                write_fd = None
+                chunks = []
+                received = 0
+                finished = False
+                while not finished:
+                    yield "Indexing %d lines in process %d, received %s" % (num_lines, pid, format_bytes(received))
+                    # Read what the pipe has, a few MB at most, at each step.
+                    step_end = received + (1 << 22)
+                    while received < step_end and select.select([read_fd], [], [], 0)[0]:
+                        chunk = os.read(read_fd, 1 << 20)
+                        if not chunk:
+                            finished = True
+                            break
+                        chunks.append(chunk)
+                        received += len(chunk)
+                pid, status = os.waitpid(pid, 0)
+                running = False
+                if os.WIFSIGNALED(status):
+                    yield "Rebuilding the dictionary failed: the worker was killed by signal %d" % os.WTERMSIG(status)
+                    return
+                if os.WEXITSTATUS(status) != 0:
+                    yield "Rebuilding the dictionary failed: the worker exited with status %d" % os.WEXITSTATUS(status)
+                    return
+                words = marshal.loads(''.join(chunks))
+                del chunks
+                self.catch_up_contexts(words, self.rebuild_changes)
+                self.swap_contexts(words)
+            finally:
+                self.rebuild_changes = None
+                os.close(read_fd)
+                if write_fd is not None:
+                    os.close(write_fd)
+                if running:
+                    os.kill(pid, signal.SIGKILL)
+                    os.waitpid(pid, 0)
+
+        yield "Rebuilt dictionary in %0.2fs. Words %d (%+d), contexts %d (%+d)" % (
             time.time() - t, self.num_words, self.num_words - old_num_words,
             self.num_contexts, self.num_contexts - old_num_contexts)
 
-    @owner_command
+    @job_command
     def purge(self, io_module, command_args, args):
         # Remove rare words.
         t = time.time()
@@ -625,14 +1829,17 @@ class PyborgBrain(Brain):
         rare_words = (word for word, contexts in self.words.iteritems() if is_rare_word(word, contexts))
 
         if not command_args:
-            return "There are %d possible rare (and alphanumeric) words to remove." % len(list(rare_words))
+            yield "There are %d possible rare (and alphanumeric) words to remove." % len(list(rare_words))
+            return
 
         num_words_to_unlearn = int(command_args[0])
         words_to_unlearn = list(islice(rare_words, num_words_to_unlearn))
-        for word in words_to_unlearn:
-            self.unlearn_word(word)
+        for start in xrange(0, len(words_to_unlearn), self.job_chunk):
+            yield "Unlearned %d of %d rare words" % (start, len(words_to_unlearn))
+            for word in words_to_unlearn[start:start + self.job_chunk]:
+                self.unlearn_word(word)
 
-        return "Unlearned %d rare words in %0.2fs." % (len(words_to_unlearn), time.time() - t)
+        yield "Unlearned %d rare words in %0.2fs." % (len(words_to_unlearn), time.time() - t)
 
     @owner_command
     def replace(self, io_module, command_args, args):
@@ -665,19 +1872,23 @@ class PyborgBrain(Brain):
         elif len(command_args) > 1:
             # create the aliases
             alias_word = command_args.pop(0)
+            for alias_pat in command_args:
+                try:
+                    re.compile(alias_pat)
+                except re.error, e:
+                    return "%s isn't a valid pattern: %s" % (alias_pat, e)
             msg = "The words : "
             if alias_word[0] != '~':
                 alias_word = '~' + alias_word
             if not (alias_word in self.settings.aliases):
                 self.settings.aliases[alias_word] = [alias_word[1:]]
-                self.replace_word(alias_word[1:], alias_word)
                 msg += alias_word[1:] + " "
-            for alias_pat in command_list:
+            for alias_pat in command_args:
                 msg += "%s " % alias_pat
                 self.settings.aliases[alias_word].append(alias_pat)
-                #replace each words by his alias
-                self.replace_word(alias_pat, alias_word)
-            msg += "have been aliased to %s" % alias_word
+            #replace each words by his alias
+            replaced = self.update_aliases()
+            msg += "have been aliased to %s (%d words replaced)" % (alias_word, replaced)
         return msg
 
     @owner_command
@@ -695,7 +1906,7 @@ class PyborgBrain(Brain):
         lines = set()
         # Search through contexts
         # Would be nice not to have find *all* the contexts, but we want their number.
-        for line_text, line_contexts in self.lines.itervalues():
+        for line_id, (line_text, line_contexts) in self.iterlines():
             line_text = " " + line_text + " "
             if context in line_text:
                 lines.add(line_text)
@@ -715,18 +1926,23 @@ class PyborgBrain(Brain):
         for line in these_lines[5:]:
             io_module.output(line, args)
 
-    @owner_command
+    @job_command
     def unlearn(self, io_module, command_args, args):
         if not command_args:
-            return
-        context = " ".join(command_args).lower()
+            return "Usage: !unlearn <expression>"
+        return self.unlearn_steps(" ".join(command_args).lower())
+
+    def unlearn_steps(self, context):
         self.log.debug("Looking to unlearn %r", context)
 
         t = time.time()
-        num_lines = len(self.lines)
-        self.unlearn_word(context)
-        unlearned = num_lines - len(self.lines)
-        return "Unlearned %d contexts in %0.2fs." % (unlearned, time.time() - t)
+        # Keep the lines found, to tell if their IDs have been reused
+        # by the time we get to them.
+        found = list((line_id, self.lines[line_id]) for line_id in self.find_lines(context))
+        unlearned = 0
+        for unlearned in self.forget_found_lines(found):
+            yield "Unlearned %d of %d contexts" % (unlearned, len(found))
+        yield "Unlearned %d contexts in %0.2fs." % (unlearned, time.time() - t)
 
     @owner_command
     def censor(self, io_module, command_args, args):
@@ -742,6 +1958,7 @@ class PyborgBrain(Brain):
                 messages.append("%s is already censored." % word)
             else:
                 self.settings.censored.append(word)
+                self.update_censored()
                 self.unlearn_word(word)
                 messages.append("Censored and unlearned %s." % word)
         return '\n'.join(messages)
@@ -755,19 +1972,171 @@ class PyborgBrain(Brain):
             word = word.lower()
             try:
                 self.settings.censored.remove(word.lower())
+                self.update_censored()
                 messages.append("Uncensored %s." % word)
             except ValueError:
                 messages.append("%s was already not censored." % word)
         return '\n'.join(messages)
 
 
+# The brain reply pool workers generate from, set only while forking them.
+_pool_brain = None
+
+
+def _generate_candidates(brain, seed_words, num_candidates, deadline, trace=None):
+    """
+    Build up to 'num_candidates' replies from random seeds among
+    'seed_words', stopping early at 'deadline'. At least one reply is
+    always built.
+    """
+    candidates = list()
+    while True:
+        candidates.append(brain.build_reply(brain.random.choice(seed_words), trace))
+        if len(candidates) >= num_candidates or time.time() >= deadline:
+            return candidates
+
+
+def _pool_generate(seed_words, num_candidates, deadline, seed):
+    _pool_brain.random.seed(seed)
+    return _generate_candidates(_pool_brain, seed_words, num_candidates, deadline)
+
+
+class CallProfiler(object):
+    """
+    Profile the brain's replies and learning for the next 'calls' calls
+    or for 'seconds', then write the stats to 'filename' and report the
+    top functions to 'io_module'. cProfile only follows one thread at a
+    time, so calls made while another thread is being profiled run
+    unprofiled.
+    """
+
+    log = logging.getLogger('CallProfiler')
+
+    def __init__(self, filename, io_module, args, calls=None, seconds=None):
+        self.filename = filename
+        self.io_module = io_module
+        self.args = args
+        self.calls_left = calls
+        self.profile = cProfile.Profile()
+        self.lock = threading.Lock()
+        self.num_calls = 0
+        self.finished = False
+        if seconds:
+            self.timer = threading.Timer(seconds, self.finish)
+            self.timer.daemon = True
+            self.timer.start()
+        else:
+            self.timer = None
+
+    def call(self, fn, *args):
+        if not self.lock.acquire(False):
+            return fn(*args)
+        try:
+            if self.finished:
+                return fn(*args)
+            result = self.profile.runcall(fn, *args)
+            self.num_calls += 1
+            if self.calls_left is not None:
+                self.calls_left -= 1
+                if self.calls_left <= 0:
+                    self._finish()
+            return result
+        finally:
+            self.lock.release()
+
+    def finish(self):
+        with self.lock:
+            self._finish()
+
+    def _finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        if self.timer is not None:
+            self.timer.cancel()
+
+        if not self.num_calls:
+            self.io_module.output("Profiled no calls.", self.args)
+            return
+        self.profile.dump_stats(self.filename)
+        stats = pstats.Stats(self.profile)
+        self.io_module.output("Profiled %d calls in %.2fs, wrote %s. Top functions by cumulative time:" % (
+            self.num_calls, stats.total_tt, self.filename), self.args)
+        top = sorted(stats.stats.iteritems(), key=lambda (func, stat): stat[3], reverse=True)[:20]
+        for (filename, line, name), (primitive_calls, num_calls, total_time, cumulative_time, callers) in top:
+            self.io_module.output("%8.3fs %8.3fs %7d  %s:%d(%s)" % (
+                cumulative_time, total_time, num_calls, os.path.basename(filename), line, name), self.args)
+
+
+class Job(object):
+    """
+    A long command run on its own thread. Each chunk of its 'steps'
+    generator is run holding 'lock', so messages are handled between
+    chunks, and the latest message yielded is posted to 'io_module'
+    every 'progress_interval' seconds, and when the job is done.
+    """
+
+    log = logging.getLogger('Job')
+
+    # Seconds to let waiting threads take the lock between chunks.
+    step_pause = 0.01
+
+    def __init__(self, number, name, steps, io_module, args):
+        self.number = number
+        self.name = name
+        self.steps = steps
+        self.io_module = io_module
+        self.args = args
+        # The latest message yielded.
+        self.status = None
+        self.started = time.time()
+        self.cancelled = False
+
+    def describe(self):
+        return "Job %d: !%s, running %ds: %s" % (self.number, self.name, time.time() - self.started,
+            self.status or "starting")
+
+    def report(self, message):
+        if self.io_module is not None:
+            self.io_module.output(message, self.args)
+        else:
+            self.log.info("!%s: %s", self.name, message)
+
+    def run(self, lock, progress_interval):
+        last_report = time.time()
+        try:
+            while True:
+                with lock:
+                    if self.cancelled:
+                        self.steps.close()
+                        self.status = "Cancelled job %d (!%s) after %ds: %s" % (self.number, self.name,
+                            time.time() - self.started, self.status or "starting")
+                        break
+                    try:
+                        status = next(self.steps)
+                    except StopIteration:
+                        break
+                if status is not None:
+                    self.status = status
+                if progress_interval and time.time() - last_report >= progress_interval:
+                    last_report = time.time()
+                    self.report(self.describe())
+                time.sleep(self.step_pause)
+        except Exception:
+            self.log.exception("Internal error running job %d (!%s)", self.number, self.name)
+            self.status = 'Oops, internal error :('
+        if self.status:
+            self.report(self.status)
+
+
 class Pyborg(object):
 
     ver_string = "I am a version 1.1.2 PyBorg"
 
     # Main command list
     commandlist = "Pyborg commands:\n!checkdict, !contexts, !help, !known, !learning, !rebuilddict, \
-!replace, !unlearn, !purge, !version, !words, !limit, !alias, !save, !censor, !uncensor, !owner"
+!replace, !unlearn, !purge, !version, !words, !limit, !alias, !save, !censor, !uncensor, !owner, !stats, !memstats, !profile, !trace, \
+!compact, !jobs, !cancel"
     commanddict = {
         "help": "Owner command. Usage: !help [command]\nPrints information about using a command, or a list of commands if no command is given",
         "version": "Usage: !version\nDisplay what version of Pyborg we are running",
@@ -779,30 +2148,68 @@ class Pyborg(object):
         "replace": "Owner command. Usage: !replace <old> <new>\nReplace all occurances of word <old> in the dictionary with <new>",
         "learning": "Owner command. Usage: !learning [on|off]\nToggle bot learning. Without arguments shows the current setting",
         "checkdict": "Owner command. Usage: !checkdict\nChecks the dictionary for broken links. Shouldn't happen, but worth trying if you get KeyError crashes",
-        "rebuilddict": "Owner command. Usage: !rebuilddict\nRebuilds dictionary links from the lines of known text. Takes a while. You probably don't need to do it unless your dictionary is very screwed",
+        "rebuilddict": "Owner command. Usage: !rebuilddict\nRebuilds dictionary links from the lines of known text, in a background process. You probably don't need to do it unless your dictionary is very screwed",
         "censor": "Owner command. Usage: !censor [word1 [...]]\nPrevent the bot using one or more words. Without arguments lists the currently censored words",
         "uncensor": "Owner command. Usage: !uncensor word1 [word2 [...]]\nRemove censorship on one or more words",
         "limit": "Owner command. Usage: !limit [number]\nSet the number of words that pyBorg can learn",
         "alias": "Owner command. Usage: !alias : Show the differents aliases\n!alias <alias> : show the words attached to this alias\n!alias <alias> <word> : link the word to the alias",
-        "owner": "Usage : !owner password\nAdd the user in the owner list"
+        "owner": "Usage : !owner password\nAdd the user in the owner list",
+        "memstats": "Owner command. Usage: !memstats\nShow an estimate of how much memory the dictionary uses, and its heaviest words",
+        "compact": "Owner command. Usage: !compact\nRebuild the dictionary in the background to give back the memory left by forgotten words and sentences",
+        "jobs": "Owner command. Usage: !jobs\nList the long commands running in the background, and how far they have got",
+        "cancel": "Owner command. Usage: !cancel number\nStop the background job with that number",
+        "profile": "Owner command. Usage: !profile <calls> | <seconds>s | stop\nProfile the next <calls> replies and learns, or those in the next <seconds>, then save the stats to a .pstats file and show the slowest functions",
+        "trace": "Owner command. Usage: !trace [next|show [number]|dump|clear]\nList the traced replies, trace the next reply, show a trace, append all traces to traces.txt or forget them. Set trace_sample_rate to trace 1 in so many replies",
+        "stats": "Owner command. Usage: !stats\nShow how long each stage of processing messages takes, and counts of messages, replies and sentences not learned"
     }
 
     log = logging.getLogger('Pyborg')
 
-    def __init__(self):
+    # Seconds between checks for a periodic task being turned on again,
+    # while its interval setting is 0.
+    disabled_poll_interval = 60
+
+    stage_seconds = metrics.histogram('pyborg_stage_seconds', "Time spent in each stage of processing a message", 'stage')
+    messages_total = metrics.counter('pyborg_messages_total', "Messages processed", 'kind')
+    replies_total = metrics.counter('pyborg_replies_total', "Replies made, by where they came from", 'source')
+    messages_in_flight = metrics.gauge('pyborg_messages_in_flight', "Messages being processed right now")
+    memory_bytes = metrics.gauge('pyborg_memory_bytes', "Estimated bytes used by each brain structure", 'structure')
+
+    def __init__(self, seed=None):
         """
-        Open the dictionary. Resize as required.
+        Open the dictionary. Resize as required. A 'seed' overrides
+        the random_seed setting.
         """
         self.settings = Settings({
+            'admit_after': Setting("Times a new word must be seen before sentences with it are learned (1 to learn them at once)", 1),
             'aliases': Setting("A list of similar words", {}),
+            'autosave_interval': Setting("Seconds between saving the dictionary in the background when it has changed (0 to never)", 0),
             'censored': Setting("Words that indicate not to learn the sentences in which they appear", []),
+            'compact_idle': Setting("Seconds without messages after which to compact the brain, if much of it has been forgotten (0 to never, eg. 600 to turn it on)", 0),
+            'decay_half_life': Setting("Days for the weight of learning a sentence to halve, so replies follow what's said lately (0 to never decay)", 0),
+            'evict': Setting("If True, forget the least used words and sentences to stay under max_words and max_lines, instead of not learning new words", False),
+            'job_progress_interval': Setting("Seconds between progress messages from long commands like !rebuilddict (0 for none)", 30),
             'ignore_list': Setting("Words to ignore for the answer", ['!.', '?.', "'", ',', ';']),
             'learning': Setting("If True, the bot will learn new words", True),
+            'max_lines': Setting("Max number of sentences to remember when evicting (0 for no limit)", 0),
             'max_words': Setting("Max number of words to learn", 6000),
+            'memstats_interval': Setting("Seconds between logging how much memory the brain uses (0 to never)", 0),
+            'metrics_port': Setting("Port to serve metrics on at http://127.0.0.1:port/metrics for Prometheus (0 to not serve them)", 0),
             'max_word_length': Setting("Max number of characters a word can have to learn it", 13),
             'min_vowel_ratio': Setting("Min ratio of vowels to characters a word can have to learn it", 0.25),
             'protect': Setting("If True, don't overwrite the dictionary and configuration on disk", False),
             'process_with': Setting("Which library to generate replies with ('pyborg' or 'megahal')", "pyborg"),
+            'random_seed': Setting("Seed for choosing replies, so the same brain always gives the same replies (None for a random seed)", None),
+            'reply_candidates': Setting("Number of candidate replies to generate, replying with the most surprising one", 1),
+            'reply_budget': Setting("Max seconds to spend generating candidate replies", 0.1),
+            # Each worker soon holds its own copy of the brain, as refcount
+            # updates un-share the pages it was forked with, so N workers
+            # take about N times the brain's memory.
+            'reply_pool_min_words': Setting("Generate candidate replies on a process pool once this many words are known (0 to never)", 0),
+            'save_compression': Setting("How to compress the saved dictionary: 'deflated' for a smaller archive.zip, 'stored' for faster saves and loads", "deflated"),
+            'trace_buffer': Setting("Number of reply traces to keep for !trace", 20),
+            'trace_sample_rate': Setting("Trace 1 in this many replies for !trace (0 to only trace on request)", 0),
+            'unfilterd_capacity': Setting("Max number of different messages without a prepared answer to count for sentences.txt", 10000),
         })
         self.settings.load('pyborg.cfg')
 
@@ -810,83 +2217,355 @@ class Pyborg(object):
             'sentences': Setting("A list of prepared answers", {}),
         })
         self.answers.load('answers.txt')
+        self.update_answers()
+
+        # The messages most often not matching a prepared answer.
+        self.unfilterd = HeavyHitters(self.settings.unfilterd_capacity)
+        self.profiler = None
+
+        # Held while the brain is used, as messages may be handled on
+        # several threads and the brain is compacted on another.
+        self.brain_lock = threading.RLock()
+        self.last_message = time.time()
 
-        self.unfilterd = {}
+        # Long commands running in the background, by their number.
+        self.running_jobs = dict()
+        self.job_numbers = count(1)
+
+        # Only one save runs at a time. Background saves are waited for
+        # by the 'save_thread'.
+        self.save_lock = threading.Lock()
+        self.save_thread = None
+
+        if seed is None:
+            seed = self.settings.random_seed
+        self.random = random.Random(seed)
 
         # Read the dictionary
         if self.settings.process_with == "pyborg":
-            self.brain = PyborgBrain(self.settings)
+            self.brain = PyborgBrain(self.settings, self.random)
         elif self.settings.process_with == "megahal":
-            self.brain = MegahalBrain(self.settings)
+            self.brain = MegahalBrain(self.settings, self.random)
         else:
             raise ValueError("Unknown 'process_with' value {0}".format(self.settings.process_with))
 
+        if self.settings.metrics_port:
+            metrics.serve(self.settings.metrics_port)
+
+        # The periodic tasks run even while their settings turn them off,
+        # so reloading the settings can turn them on.
+        memstats_thread = threading.Thread(target=self._log_memory_stats, name='memstats')
+        memstats_thread.daemon = True
+        memstats_thread.start()
+
+        # Settings reloaded by watch_config(), for the brain to catch up
+        # with before the next message.
+        self.reloaded_lock = threading.Lock()
+        self.reloaded = set()
+
+        self.saved_changes = self.brain.changes
+        autosave_thread = threading.Thread(target=self._autosave, name='autosave')
+        autosave_thread.daemon = True
+        autosave_thread.start()
+
+        idle_thread = threading.Thread(target=self._compact_when_idle, name='idle')
+        idle_thread.daemon = True
+        idle_thread.start()
+
         self.settings.save()
 
-    def save_all(self):
+    def memory_stats(self, sample_size=1000):
+        """
+        Estimate the bytes used by the brain's structures and by the
+        unmatched messages in 'unfilterd'. See Brain.memory_stats().
+        """
+        stats = self.brain.memory_stats(sample_size)
+        getsizeof = sys.getsizeof
+        heap = self.unfilterd.heap
+        stats['bytes']['unfilterd'] = (getsizeof(self.unfilterd.counts) + getsizeof(heap)
+            + estimate_size(self.unfilterd.iteritems(), len(self.unfilterd), sample_size,
+                lambda (body, count): getsizeof(body) + getsizeof(count))
+            + len(heap) * getsizeof((0, '')))
+        for structure, num_bytes in stats['bytes'].iteritems():
+            self.memory_bytes.set(num_bytes, structure)
+        return stats
+
+    def memory_summary(self, stats):
+        sizes = stats['bytes']
+        return "Memory (estimated): %s; total %s, RSS %s" % (
+            ", ".join("%s %s" % (structure, format_bytes(sizes[structure])) for structure in sorted(sizes)),
+            format_bytes(sum(sizes.itervalues())), format_bytes(metrics.rss()))
+
+    def _log_memory_stats(self):
+        while True:
+            time.sleep(self.settings.memstats_interval or self.disabled_poll_interval)
+            if not self.settings.memstats_interval:
+                continue
+            with self.brain_lock:
+                stats = self.memory_stats()
+            self.log.info(self.memory_summary(stats))
+
+    def update_answers(self):
+        """
+        Compile the prepared answers, after they have been changed.
+        """
+        self._answer_res = list((re.compile('(?:%s)$' % sentence), replies)
+            for sentence, replies in self.answers.sentences.items())
+
+    def _validate_settings(self, changes):
+        patterns = list(changes.get('censored', ()))
+        for alias_word, alias_patterns in changes.get('aliases', {}).iteritems():
+            if not isinstance(alias_patterns, list):
+                raise ValueError("the patterns for alias %s should be a list" % alias_word)
+            patterns.extend(alias_patterns)
+        for pattern in patterns:
+            try:
+                re.compile(pattern)
+            except (re.error, TypeError), e:
+                raise ValueError("bad pattern %r: %s" % (pattern, e))
+
+    def _validate_answers(self, changes):
+        for sentence, replies in changes.get('sentences', {}).iteritems():
+            try:
+                re.compile(sentence)
+            except (re.error, TypeError), e:
+                raise ValueError("answer pattern %r is bad: %s" % (sentence, e))
+            if not isinstance(replies, (list, tuple)) or not replies:
+                raise ValueError("the answers to %r should be a list of them" % sentence)
+
+    def watch_config(self, interval):
+        """
+        Reload pyborg.cfg and answers.txt when they change, checking
+        every 'interval' seconds on a background thread.
+        """
+        watch_thread = threading.Thread(target=self._watch_config, args=(interval,), name='config')
+        watch_thread.daemon = True
+        watch_thread.start()
+
+    def _watch_config(self, interval):
+        while True:
+            time.sleep(interval)
+            self.reload_config()
+
+    def reload_config(self):
+        """
+        Reload pyborg.cfg and answers.txt if they have been changed.
+        The answers are recompiled here, but the brain catches up with
+        reloaded settings on the thread handling messages.
+        """
+        for settings, validate in ((self.settings, self._validate_settings), (self.answers, self._validate_answers)):
+            try:
+                changed = settings.reload(validate)
+            except ValueError, e:
+                self.log.error("Not reloading %s: %s", settings._filename, e)
+                continue
+            if not changed:
+                continue
+            self.log.info("Reloaded %s from %s", ", ".join(changed), settings._filename)
+            if settings is self.answers:
+                self.update_answers()
+            else:
+                if 'unfilterd_capacity' in changed:
+                    self.unfilterd.resize(self.settings.unfilterd_capacity)
+                with self.reloaded_lock:
+                    self.reloaded.update(changed)
+
+    def _apply_reloaded(self):
+        with self.reloaded_lock:
+            reloaded, self.reloaded = self.reloaded, set()
+        self.brain.settings_changed(reloaded)
+
+    def _compact_when_idle(self):
+        while True:
+            time.sleep(min(self.settings.compact_idle, 60) or self.disabled_poll_interval)
+            compact_idle = self.settings.compact_idle
+            if not compact_idle:
+                continue
+            if time.time() - self.last_message >= compact_idle and self.brain.needs_compacting():
+                self.start_job('compact', self.compact_brain())
+
+    def compact_brain(self):
+        """
+        Compact the brain as a job, reporting the memory reclaimed.
+        """
+        before = sum(self.memory_stats()['bytes'].itervalues())
+        rss_before = metrics.rss()
+        t = time.time()
+        for step in self.brain.compact_steps():
+            yield "Compacting the brain"
+        gc.collect()
+        after = sum(self.memory_stats()['bytes'].itervalues())
+        yield "Compacted the brain in %.1fs, reclaiming %s (estimated); RSS %s -> %s" % (
+            time.time() - t, format_bytes(max(before - after, 0)), format_bytes(rss_before), format_bytes(metrics.rss()))
+
+    def start_job(self, name, steps, io_module=None, args=None):
+        """
+        Run the generator 'steps' of the command 'name' as a Job on a
+        new thread, reporting to 'io_module' if given. Returns the job,
+        or None if the command is already running.
+        """
+        with self.brain_lock:
+            if any(job.name == name for job in self.running_jobs.itervalues()):
+                return None
+            job = Job(next(self.job_numbers), name, steps, io_module, args)
+            self.running_jobs[job.number] = job
+        job_thread = threading.Thread(target=self._run_job, args=(job,), name='job-%d' % job.number)
+        job_thread.daemon = True
+        job_thread.start()
+        return job
+
+    def _run_job(self, job):
+        try:
+            job.run(self.brain_lock, self.settings.job_progress_interval)
+        finally:
+            with self.brain_lock:
+                del self.running_jobs[job.number]
+
+    def _autosave(self):
+        while True:
+            time.sleep(self.settings.autosave_interval or self.disabled_poll_interval)
+            if not self.settings.autosave_interval or self.brain.changes == self.saved_changes:
+                continue
+            try:
+                self.save_all(background=True)
+            except (OSError, IOError):
+                self.log.exception("Couldn't autosave the dictionary")
+
+    def save_all(self, background=False):
+        """
+        Save the dictionary, sentences and settings. Where we can fork,
+        a 'background' save writes them from a copy-on-write snapshot in
+        a child process while we carry on. Returns False if another
+        background save was already running.
+        """
         if self.settings.protect:
-            return
+            return True
+
+        # The brain lock is taken first, as commands save while holding
+        # it, and keeps the brain from changing while it's written or
+        # forked.
+        with self.brain_lock, self.save_lock:
+            if self.save_thread is not None and self.save_thread.is_alive():
+                if background:
+                    return False
+                self.save_thread.join()
+
+            # The settings are small, and saving them here keeps track of
+            # what has changed since.
+            self.settings.save()
+
+            changes = self.brain.changes
+            # Message threads count unanswered messages without the brain
+            # lock, so copy them here: a child forked while one of them
+            # held the counts' lock would wait for it forever.
+            sentences = list(self.unfilterd.iteritems())
+            if not (background and hasattr(os, 'fork')):
+                self._write_all(sentences)
+                self.saved_changes = changes
+                return True
+
+            pid = fork()
+            if pid == 0:
+                status = 1
+                try:
+                    self._write_all(sentences)
+                    status = 0
+                except Exception:
+                    self.log.exception("Background save failed")
+                finally:
+                    os._exit(status)
+
+            self.save_thread = threading.Thread(target=self._wait_for_save, args=(pid, changes, time.time()),
+                name='save')
+            self.save_thread.daemon = True
+            self.save_thread.start()
+            return True
+
+    def _wait_for_save(self, pid, changes, started):
+        pid, status = os.waitpid(pid, 0)
+        if status == 0:
+            self.saved_changes = changes
+            self.log.info("Saved the dictionary in the background in %.1fs", time.time() - started)
+        else:
+            self.log.error("Background save failed with status %d", status)
 
+    def _write_all(self, sentences):
         self.brain.save()
 
-        sentence_list = sorted((sentence for sentence in self.unfilterd.iteritems()), key=lambda s: s[1])
+        sentence_list = sorted(sentences, key=lambda s: s[1])
         with open('sentences.txt', 'w') as sentence_file:
             for word, count in sentence_list:
                 sentence_file.write(word)
                 sentence_file.write('\n')
 
-        self.settings.save()
-
     def process_msg(self, io_module, body, replyrate, learn, args, owner=False):
         """
         Process message 'body' and pass back to IO module with args.
         If owner, allow owner commands.
         """
+        self.last_message = time.time()
+        if self.reloaded:
+            with self.brain_lock:
+                self._apply_reloaded()
+
+        self.messages_in_flight.inc()
+        try:
+            self._process_msg(io_module, body, replyrate, learn, args, owner)
+        finally:
+            self.messages_in_flight.dec()
+
+    def _process_msg(self, io_module, body, replyrate, learn, args, owner):
         # add trailing space so sentences are broken up correctly
         body = body + " "
 
         # Parse commands
         if body.startswith('!'):
-            self.do_commands(io_module, body, args, owner)
+            self.messages_total.inc('command')
+            with self.brain_lock:
+                self.do_commands(io_module, body, args, owner)
             return
+        self.messages_total.inc('message')
 
         # Filter out garbage and do some formatting
-        body = self.brain.filter_message(body)
+        with self.stage_seconds.time('filter'):
+            body = self.brain.filter_message(body)
 
         # Learn from input
         if learn == 1 and self.settings.learning:
-            self.brain.learn(body)
+            with self.stage_seconds.time('learn'), self.brain_lock:
+                self.profiled(self.brain.learn, body)
+                if self.brain.needs_evicting():
+                    self.start_job('evict', self.brain.evict_steps())
 
         # Make a reply if desired
-        if random.randint(0, 99) < replyrate:
+        if self.random.randint(0, 99) < replyrate:
             message = ""
 
             #Look if we can find a prepared answer
-            for sentence in self.answers.sentences.keys():
-                pattern = "^%s$" % sentence
-                if re.search(pattern, body):
-                    message = self.answers.sentences[sentence][random.randint(0, len(self.answers.sentences[sentence]) - 1)]
-                    break
+            with self.stage_seconds.time('answers'):
+                for sentence_re, replies in self._answer_res:
+                    if sentence_re.match(body):
+                        message = self.random.choice(replies)
+                        self.replies_total.inc('answer')
+                        break
                 else:
-                    if body in self.unfilterd:
-                        self.unfilterd[body] = self.unfilterd[body] + 1
-                    else:
-                        self.unfilterd[body] = 0
+                    self.unfilterd.add(body)
 
             if message == "":
-                message = self.brain.reply(body)
+                with self.stage_seconds.time('reply'), self.brain_lock:
+                    message = self.profiled(self.brain.reply, body)
+                self.replies_total.inc('brain' if message else 'empty')
 
-            # single word reply: always output
-            if len(message.split()) == 1:
-                io_module.output(message, args)
-                return
             # empty. do not output
-            if message == "":
-                return
-            # else output
-            if not owner:
-                time.sleep(.2 * len(message))
-            io_module.output(message, args)
+            if message != "":
+                # single word reply: always output at once
+                if len(message.split()) != 1 and not owner:
+                    time.sleep(.2 * len(message))
+                with self.stage_seconds.time('output'):
+                    io_module.output(message, args)
+
+            with self.brain_lock:
+                self.brain.after_reply()
 
     def do_commands(self, io_module, body, args, owner):
         """
@@ -913,7 +2592,16 @@ class Pyborg(object):
 
         self.log.debug("Yay, running command %r!", command)
         try:
-            message = command_method(io_module, command_list, args)
+            if getattr(command_method, 'is_job', False):
+                steps = command_method(io_module, command_list, args)
+                if isinstance(steps, basestring):
+                    message = steps
+                else:
+                    job = self.start_job(command, steps, io_module, args)
+                    message = ("Running !%s as job %d" % (command, job.number) if job
+                        else "!%s is already running" % command)
+            else:
+                message = command_method(io_module, command_list, args)
         except Exception, exc:
             message = 'Oops, internal error :('
             self.log.exception('Internal error dispatching command %r', body)
@@ -926,8 +2614,12 @@ class Pyborg(object):
 
     @owner_command
     def save(self, io_module, command_args, args):
-        self.save_all()
-        return "Dictionary saved"
+        if not hasattr(os, 'fork'):
+            self.save_all()
+            return "Dictionary saved"
+        if not self.save_all(background=True):
+            return "The dictionary is already being saved"
+        return "Saving the dictionary in the background"
 
     @owner_command
     def help(self, io_module, command_args, args):
@@ -950,6 +2642,51 @@ class Pyborg(object):
             for i in io_module.commandlist.split("\n"):
                 io_module.output( i, args )
 
+    @owner_command
+    def stats(self, io_module, command_args, args):
+        report = metrics.summary()
+        if not report:
+            return "No stats yet."
+        for line in report.split("\n"):
+            io_module.output(line, args)
+
+    @owner_command
+    def memstats(self, io_module, command_args, args):
+        stats = self.memory_stats()
+        messages = [self.memory_summary(stats)]
+        percentiles = stats.get('contexts_per_word')
+        if percentiles:
+            messages.append("Contexts per word: p50 %d, p90 %d, p99 %d, max %d" % (
+                percentiles[50], percentiles[90], percentiles[99], percentiles[100]))
+        heaviest = stats.get('heaviest_words')
+        if heaviest:
+            messages.append("Heaviest words: " + ", ".join("%s (%d contexts, %s)" % (word, contexts, format_bytes(size))
+                for word, contexts, size in heaviest))
+        return "\n".join(messages)
+
+    @job_command
+    def compact(self, io_module, command_args, args):
+        return self.compact_brain()
+
+    @owner_command
+    def jobs(self, io_module, command_args, args):
+        with self.brain_lock:
+            jobs = sorted(self.running_jobs.itervalues(), key=lambda job: job.number)
+        if not jobs:
+            return "No jobs running."
+        return "\n".join(job.describe() for job in jobs)
+
+    @owner_command
+    def cancel(self, io_module, command_args, args):
+        if len(command_args) != 1 or not command_args[0].isdigit():
+            return "Usage: !cancel job number"
+        with self.brain_lock:
+            job = self.running_jobs.get(int(command_args[0]))
+            if job is None:
+                return "No job %s is running." % command_args[0]
+            job.cancelled = True
+        return "Cancelling job %d (!%s)" % (job.number, job.name)
+
     @owner_command
     def learning(self, io_module, command_args, args):
         msg = "Learning mode "
@@ -973,8 +2710,45 @@ class Pyborg(object):
         self.save_all()
         sys.exit()
 
+    @owner_command
+    def profile(self, io_module, command_args, args):
+        profiler = self.profiler
+        if not command_args:
+            if profiler is None or profiler.finished:
+                return "Not profiling. Usage: !profile <calls> | <seconds>s | stop"
+            return "Profiling, %d calls so far." % profiler.num_calls
+        if command_args[0].lower() == 'stop':
+            if profiler is None or profiler.finished:
+                return "Not profiling."
+            profiler.finish()
+            return
+
+        if profiler is not None and not profiler.finished:
+            return "Already profiling. Use !profile stop first."
+        try:
+            if command_args[0].lower().endswith('s'):
+                calls, seconds = None, float(command_args[0][:-1])
+                what = "for %gs" % seconds
+            else:
+                calls, seconds = int(command_args[0]), None
+                what = "for %d calls" % calls
+        except ValueError:
+            return "Usage: !profile <calls> | <seconds>s | stop"
+        filename = time.strftime('profile-%Y%m%d-%H%M%S.pstats')
+        self.profiler = CallProfiler(filename, io_module, args, calls, seconds)
+        return "Profiling replies and learning %s." % what
+
+    def profiled(self, fn, *args):
+        """
+        Call 'fn', profiling it if the owner asked for !profile.
+        """
+        profiler = self.profiler
+        if profiler is None:
+            return fn(*args)
+        return profiler.call(fn, *args)
+
     def reply(self, body):
-        return self.brain.reply(body)
+        return self.profiled(self.brain.reply, body)
 
     def learn(self, body):
-        return self.brain.learn(body)
+        return self.profiled(self.brain.learn, body)
@@ -3,10 +3,11 @@ from distutils.core import setup
 setup(
     name='pyborg',
     version='1.1.2',
-    py_modules=['pyborg', 'cfgfile'],
+    py_modules=['pyborg', 'cfgfile', 'irclogs', 'metrics'],
     scripts=[
         'bin/pyborg-filein.py',
         'bin/pyborg-irc.py',
         'bin/pyborg-linein.py',
+        'bin/pyborg-merge.py',
     ],
 )